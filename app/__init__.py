@@ -1,18 +1,12 @@
-import logging
-
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from structlog import wrap_logger
 
+from app.log import configure_logging
 import settings
 
 __version__ = "3.15.0"
 
-logging.basicConfig(format=settings.LOGGING_FORMAT,
-                    datefmt="%Y-%m-%dT%H:%M:%S",
-                    level=settings.LOGGING_LEVEL)
-
-logger = wrap_logger(logging.getLogger(__name__))
+logger = configure_logging()
 
 logger.info("Starting SDX Store", version=__version__)
 
@@ -0,0 +1,160 @@
+from contextlib import contextmanager
+import functools
+import threading
+
+from flask import g, has_app_context, jsonify
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+
+from app import logger
+import settings
+
+# Postgres error codes for a statement cancelled by statement_timeout and a lock wait ended by lock_timeout
+QUERY_CANCELED = '57014'
+LOCK_NOT_AVAILABLE = '55P03'
+
+# Every route class a view is admitted in
+ROUTE_CLASSES = ('ingest', 'read', 'list', 'admin', 'changes')
+
+SET_TIMEOUTS = text("SELECT set_config('statement_timeout', :statement_timeout, true), "
+                    "set_config('lock_timeout', :lock_timeout, true)")
+
+
+def parse_limits(value):
+    """Parses 'ingest=16,read=8' into {'ingest': 16, 'read': 8}"""
+    limits = {}
+    for item in filter(None, value.split(',')):
+        route_class, _, limit = item.partition('=')
+        limits[route_class.strip()] = int(limit)
+    return limits
+
+
+class AdmissionController:
+    """Limits how many requests of each route class a process works on at once, so that when the database
+    slows down requests are turned away quickly instead of queueing until upstream gives up.
+
+    Each class has its own limit, and all classes share a total.  The last reserved slots of the total can
+    only be used by the priority classes, so bulk reads can't crowd out ingest.  A class without a limit of its
+    own is only held to the total.
+    """
+
+    def __init__(self, limits, total, reserved, priority, statement_timeouts, lock_timeouts):
+        self.limits = dict(dict.fromkeys(ROUTE_CLASSES, total), **limits)
+        self.total = total
+        self.reserved = reserved
+        self.priority = priority
+        self.statement_timeouts = statement_timeouts
+        self.lock_timeouts = lock_timeouts
+        self.in_flight = dict.fromkeys(self.limits, 0)
+        self.admitted = dict.fromkeys(self.limits, 0)
+        self.shed = dict.fromkeys(self.limits, 0)
+        self.timed_out = dict.fromkeys(self.limits, 0)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, route_class):
+        with self._lock:
+            total = self.total if route_class in self.priority else self.total - self.reserved
+            if self.in_flight[route_class] >= self.limits[route_class] or sum(self.in_flight.values()) >= total:
+                self.shed[route_class] += 1
+                return False
+            self.in_flight[route_class] += 1
+            self.admitted[route_class] += 1
+            return True
+
+    def release(self, route_class):
+        with self._lock:
+            self.in_flight[route_class] -= 1
+
+    def status(self):
+        return {route_class: {'limit': self.limits[route_class],
+                              'in_flight': self.in_flight[route_class],
+                              'admitted': self.admitted[route_class],
+                              'shed': self.shed[route_class],
+                              'timed_out': self.timed_out[route_class]} for route_class in self.limits}
+
+
+controller = AdmissionController(limits=parse_limits(settings.ADMISSION_LIMITS),
+                                 total=settings.ADMISSION_TOTAL,
+                                 reserved=settings.ADMISSION_RESERVED,
+                                 priority={'ingest'},
+                                 statement_timeouts=parse_limits(settings.STATEMENT_TIMEOUTS),
+                                 lock_timeouts=parse_limits(settings.LOCK_TIMEOUTS))
+
+
+def shed(route_class):
+    """The 503 with Retry-After for a request of route_class turned away by try_acquire"""
+    logger.warning("Request shed", route_class=route_class)
+    response = jsonify({'status': 503, 'message': 'Service overloaded, retry later'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER)
+    return response
+
+
+def admit(route_class):
+    """Decorates a view so that it is only run if there is capacity for another request of route_class,
+    otherwise it gets a 503 with Retry-After.  Database transactions started by the view get the class's
+    statement_timeout and lock_timeout.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not controller.try_acquire(route_class):
+                return shed(route_class)
+
+            g.route_class = route_class
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(route_class)
+        return wrapper
+    return decorator
+
+
+# The route class of work a request hands to other threads, such as ShardSet.scatter()'s, which have no app context
+_delegated = threading.local()
+
+
+def current_route_class():
+    """The route class of the request this thread is working for, if any"""
+    if has_app_context():
+        return g.get('route_class')
+    return getattr(_delegated, 'route_class', None)
+
+
+@contextmanager
+def working_for(route_class):
+    """Gives the transactions this thread starts inside the block the timeouts of route_class, for a thread doing
+    part of a request's work outside its app context
+    """
+    previous = getattr(_delegated, 'route_class', None)
+    _delegated.route_class = route_class
+    try:
+        yield
+    finally:
+        _delegated.route_class = previous
+
+
+@event.listens_for(Engine, 'begin')
+def apply_timeouts(connection):
+    """Sets the timeouts for the current request's route class, local to the transaction that is starting.  Every
+    transaction begins here, whether a session's or one started with engine.begin() or connection.begin().  Work done
+    outside one, on a connection from engine.connect() alone, doesn't get the timeouts
+    """
+    route_class = current_route_class()
+    if route_class is None:
+        return
+
+    connection.execute(SET_TIMEOUTS,
+                       statement_timeout=str(controller.statement_timeouts.get(route_class, 0)),
+                       lock_timeout=str(controller.lock_timeouts.get(route_class, 0)))
+
+
+@event.listens_for(Engine, 'handle_error')
+def count_timeouts(context):
+    route_class = current_route_class()
+    if route_class is None:
+        return
+
+    if getattr(context.original_exception, 'pgcode', None) in (QUERY_CANCELED, LOCK_NOT_AVAILABLE):
+        controller.timed_out[route_class] += 1
+        logger.warning("Statement timed out", route_class=route_class, pgcode=context.original_exception.pgcode)
@@ -0,0 +1,159 @@
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+
+from app import logger
+
+# Each index entry is a tx_id, then the offset and length of the compressed block in the segment that holds it
+INDEX_ENTRY = struct.Struct('>16sQI')
+
+
+class SegmentIndex:
+    """A memory-mapped, sorted index file.  Binary searched in place, so opening one costs nothing
+    but an mmap however many tx_ids it covers
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = IndexKeys(self.mmap)
+
+    def find(self, key):
+        """Returns (offset, length) of the block holding key, or None"""
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            _, offset, length = INDEX_ENTRY.unpack_from(self.mmap, i * INDEX_ENTRY.size)
+            return offset, length
+        return None
+
+
+class IndexKeys:
+    """Sequence view over the tx_ids in an index, for bisect"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        start = i * INDEX_ENTRY.size
+        return self.buffer[start:start + 16]
+
+
+class Archive:
+    """Append-only store for responses that have been removed from the database.
+
+    Each archive run writes one segment: the responses sorted by tx_id, in blocks of block_size
+    records that are each zlib-compressed NDJSON.  Segments are named by the sha256 of their contents
+    and never modified.  Alongside each segment is a sorted index of tx_id to block.  Once both are on
+    disk the segment's name is appended to the manifest, so a segment is only visible once it is complete.
+    """
+
+    manifest = 'MANIFEST'
+
+    def __init__(self, directory, block_size=256):
+        self.directory = directory
+        self.block_size = block_size
+        self._indexes = {}
+        self._order = []
+        self._manifest_size = None
+        self._lock = threading.Lock()
+
+    def write_segment(self, records):
+        """Archives records, dicts with tx_id, ts, invalid and data keys, and returns the segment's name"""
+        if not records:
+            return None
+
+        records = sorted(records, key=lambda record: uuid.UUID(record['tx_id']).bytes)
+
+        blocks = []
+        entries = []
+        offset = 0
+        for start in range(0, len(records), self.block_size):
+            chunk = records[start:start + self.block_size]
+            block = zlib.compress(''.join(json.dumps(record) + '\n' for record in chunk).encode('utf-8'))
+            for record in chunk:
+                entries.append(INDEX_ENTRY.pack(uuid.UUID(record['tx_id']).bytes, offset, len(block)))
+            blocks.append(block)
+            offset += len(block)
+
+        segment = b''.join(blocks)
+        name = hashlib.sha256(segment).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_file(name + '.seg', segment)
+        self._write_file(name + '.idx', b''.join(entries))
+        self._append_to_manifest(name)
+        logger.info("Wrote archive segment", segment=name, count=len(records), size=len(segment))
+        return name
+
+    def get(self, tx_id):
+        """Returns the archived record for tx_id, or None.  The newest segment wins if there is more than one"""
+        key = uuid.UUID(tx_id).bytes
+        for name, index in self._segments():
+            location = index.find(key)
+            if location is None:
+                continue
+
+            offset, length = location
+            with open(os.path.join(self.directory, name + '.seg'), 'rb') as f:
+                f.seek(offset)
+                block = zlib.decompress(f.read(length))
+            for line in block.splitlines():
+                record = json.loads(line)
+                if uuid.UUID(record['tx_id']).bytes == key:
+                    return record
+        return None
+
+    def segment_count(self):
+        return len(self._segments())
+
+    def _segments(self):
+        """Returns [(name, index)] for every complete segment, newest first.  The manifest is only read
+        again when it changes
+        """
+        path = os.path.join(self.directory, self.manifest)
+        try:
+            manifest_size = os.stat(path).st_size
+        except FileNotFoundError:
+            return []
+
+        with self._lock:
+            if manifest_size != self._manifest_size:
+                with open(path) as f:
+                    names = f.read().split()
+                for name in names:
+                    if name not in self._indexes:
+                        self._indexes[name] = SegmentIndex(os.path.join(self.directory, name + '.idx'))
+                self._order = list(reversed(names))
+                self._manifest_size = manifest_size
+            return [(name, self._indexes[name]) for name in self._order]
+
+    def _append_to_manifest(self, name):
+        fd = os.open(os.path.join(self.directory, self.manifest), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (name + '\n').encode('ascii'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_file(self, filename, contents):
+        path = os.path.join(self.directory, filename)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
@@ -0,0 +1,137 @@
+import hashlib
+import math
+import threading
+import uuid
+
+from app import logger
+
+
+class BloomFilter:
+    """Fixed size Bloom filter sized for capacity keys at the given false positive rate"""
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class TxIdFilter:
+    """Per process Bloom filter over every stored tx_id, so that most lookups of a tx_id that was never
+    stored can be answered without the database.
+
+    Until the initial scan has finished every tx_id is a "maybe".  After that, "no" is definite for
+    anything written by this process, and for anything written by other processes once their change
+    notification has arrived.  The scan only starts once every database is being listened to, and starts
+    again from an empty filter whenever a listener reconnects, since notifications sent while it was
+    disconnected are lost.  Deletes never clear bits, so removed tx_ids are false positives until then.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        self.ready = False
+        self.listening = False
+        self.count = 0
+        self.negatives = 0
+        self.maybes = 0
+        self._lock = threading.Lock()
+        self._loader = None
+        self._generation = 0
+
+    @staticmethod
+    def key(tx_id):
+        return uuid.UUID(tx_id).bytes
+
+    def add(self, tx_id):
+        key = self.key(tx_id)
+        with self._lock:
+            self.filter.add(key)
+            self.count += 1
+
+    def add_all(self, tx_ids):
+        for tx_id in tx_ids:
+            try:
+                self.add(tx_id)
+            except ValueError:
+                pass
+
+    def might_contain(self, tx_id):
+        if self.ready and self.key(tx_id) not in self.filter:
+            self.negatives += 1
+            return False
+        self.maybes += 1
+        return True
+
+    def listen(self, scan):
+        """Called once notifications of every write are arriving, on each (re)connection.  Anything written before
+        then may have been missed, so the filter is rebuilt from a fresh scan, and gives no definite answers until
+        it is done.  Tx_ids notified from now on go into the new filter
+        """
+        with self._lock:
+            self.listening = True
+            self._reset()
+        self.load(scan)
+
+    def lost(self):
+        """Called when notifications may be being missed.  Stops definite answers until listen() is called again"""
+        with self._lock:
+            self.listening = False
+            self._reset()
+        logger.warning("Change notifications lost, tx_id filter unloaded")
+
+    def load(self, scan):
+        """Adds every tx_id yielded by scan in a background thread, then starts giving definite answers.  Does
+        nothing before listen(), or while a scan is running or after one has finished.  Scans again after one failed
+        """
+        with self._lock:
+            if not self.listening or self._loader is not None:
+                return
+            loader = self._loader = threading.Thread(target=self._load, args=(scan, self._generation),
+                                                     name="tx-id-filter-loader", daemon=True)
+        loader.start()
+
+    def _reset(self):
+        # Any scan still running belongs to an older generation, and stops
+        self.filter = BloomFilter(self.capacity, self.error_rate)
+        self.count = 0
+        self.ready = False
+        self._loader = None
+        self._generation += 1
+
+    def _load(self, scan, generation):
+        try:
+            for tx_id in scan():
+                if self._generation != generation:
+                    return
+                self.add(tx_id)
+        except Exception as e:
+            logger.error("Could not load tx_id filter, existence checks will use the database", error=e)
+            with self._lock:
+                if self._generation == generation:
+                    self._loader = None
+            return
+
+        with self._lock:
+            if self._generation != generation:
+                return
+            self.ready = True
+        logger.info("Loaded tx_id filter", count=self.count)
+
+    def status(self):
+        return {'ready': self.ready, 'listening': self.listening, 'count': self.count, 'negatives': self.negatives,
+                'maybes': self.maybes}
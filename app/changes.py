@@ -0,0 +1,189 @@
+import re
+import select
+import threading
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from app import logger
+
+
+class ChangeListener:
+    """Holds a single LISTEN connection to a database for the whole process and wakes up any
+    request threads that are waiting for new responses to be written.
+
+    Waiting requests never touch the database, so idle long-polls cost one
+    blocked thread and nothing else.
+    """
+
+    poll_interval = 5
+    reconnect_delay = 1
+
+    def __init__(self, dsn, channel, condition=None):
+        self.dsn = dsn
+        self.channel = channel
+        self.generation = 0
+        self._condition = condition or threading.Condition()
+        self.listening = False
+        self._subscribers = []
+        self._on_listen = []
+        self._on_lost = []
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the listening thread if it isn't already running"""
+        with self._start_lock:
+            if self._stopped.is_set():
+                return
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="change-listener", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Stops listening for good.  The connection is closed within poll_interval"""
+        self._stopped.set()
+
+    def subscribe(self, callback, on_listen=None, on_lost=None):
+        """Register a callable that is passed the list of payloads of every batch of notifications.  on_listen is
+        called each time LISTEN has taken effect on a new connection, before any of its notifications, and on_lost
+        each time that connection is lost.  Notifications sent in between are never seen
+        """
+        self._subscribers.append(callback)
+        if on_listen:
+            self._on_listen.append(on_listen)
+        if on_lost:
+            self._on_lost.append(on_lost)
+        self.start()
+
+    def current(self):
+        """Returns a token to pass to wait() so that notifications arriving in between
+        a database read and the call to wait() are not missed
+        """
+        self.start()
+        with self._condition:
+            return self.generation
+
+    def wait(self, generation, timeout):
+        """Blocks until a notification newer than generation arrives or the timeout expires.
+        Returns True if something changed.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != generation, timeout)
+
+    def _publish(self, payloads):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+        self._call(self._subscribers, payloads)
+
+    def _call(self, callbacks, *args):
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("Change listener subscriber failed", error=e)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except psycopg2.Error as e:
+                logger.error("Change listener connection lost", error=e)
+                self._stopped.wait(self.reconnect_delay)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+            logger.info("Listening for new responses", channel=self.channel)
+            self.listening = True
+            self._call(self._on_listen)
+
+            # Anything written while we were (re)connecting is picked up by waking everyone once
+            self._publish([])
+
+            while not self._stopped.is_set():
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                payloads = []
+                while conn.notifies:
+                    payloads.append(conn.notifies.pop(0).payload)
+                if payloads:
+                    self._publish(payloads)
+        finally:
+            conn.close()
+            if self.listening:
+                self.listening = False
+                self._call(self._on_lost)
+
+
+class ChangeListeners:
+    """A ChangeListener for each shard's database.  They share a condition, so that a request waiting on all of
+    them is woken by a write to any one
+    """
+
+    def __init__(self, dsns, channel):
+        self._condition = threading.Condition()
+        self.listeners = [ChangeListener(dsn, channel, self._condition) for dsn in dsns]
+
+    def subscribe(self, callback, on_listen=None, on_lost=None):
+        """As ChangeListener.subscribe(), except that on_listen is only called once every listener is listening"""
+        def listened():
+            if on_listen and all(listener.listening for listener in self.listeners):
+                on_listen()
+
+        for listener in self.listeners:
+            listener.subscribe(callback, listened, on_lost)
+
+    def current(self):
+        """Returns a token to pass to wait(), as ChangeListener.current() does"""
+        for listener in self.listeners:
+            listener.start()
+        with self._condition:
+            return self._generations()
+
+    def wait(self, generations, timeout):
+        """Blocks until a notification arrives on any of the databases after generations, or the timeout expires"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._generations() != generations, timeout)
+
+    def stop(self):
+        for listener in self.listeners:
+            listener.stop()
+
+    def _generations(self):
+        return tuple(listener.generation for listener in self.listeners)
+
+
+# One shard's position in a change feed cursor: write_txid-seq, or a plain seq
+POSITION = re.compile(r'(?:(\d+)-)?(\d+)')
+
+
+def parse_cursor(cursor, count):
+    """Returns the position in each of count shards held by a change feed cursor, as (write_txid, seq) pairs.  Each
+    shard's position is its write_txid and seq joined by '-', and the shards' are joined by '.'.  A position that is
+    a plain seq, as in cursors made before the feed was ordered by write_txid, is given as (None, seq).  So is the
+    start, 0.  Shards added since the cursor was made are read from the start.  Raises ValueError for anything else
+    """
+    positions = []
+    for part in str(cursor).split('.'):
+        match = POSITION.fullmatch(part)
+        if not match:
+            raise ValueError(f"Cursor {cursor} is not a change feed cursor")
+        write_txid, seq = match.groups()
+        positions.append((int(write_txid) if write_txid else None, int(seq)))
+    if len(positions) > count:
+        raise ValueError(f"Cursor {cursor} is not one of {count} shards")
+    return positions + [(None, 0)] * (count - len(positions))
+
+
+def format_cursor(positions):
+    """The cursor for the position read to in each shard"""
+    return '.'.join(str(seq) if write_txid is None else f'{write_txid}-{seq}' for write_txid, seq in positions)
@@ -0,0 +1,63 @@
+from collections import namedtuple
+from string import ascii_lowercase
+
+from sqlalchemy.dialects.postgresql import insert
+
+from app.models import response_comments
+
+# Where a survey's respondents leave a comment: the qcode of the comment text, the checkbox qcodes reported as
+# selected with it, and further free text qcodes exported in their own columns
+CommentRule = namedtuple('CommentRule', ['comment', 'checkboxes', 'additional'])
+
+CHECKBOXES_146 = tuple('146' + letter for letter in ascii_lowercase)
+
+DEFAULT_RULE = CommentRule('146', CHECKBOXES_146, ())
+
+COMMENT_RULES = {
+    '187': CommentRule('500', CHECKBOXES_146, ()),
+    '134': CommentRule('300',
+                       CHECKBOXES_146 + ('91w', '92w1', '92w2', '94w1', '94w2', '95w', '96w', '97w',
+                                         '91f', '92f1', '92f2', '94f1', '94f2', '95f', '96f', '97f',
+                                         '191m', '192m1', '192m2', '194m1', '194m2', '195m', '196m', '197m',
+                                         '191w4', '192w41', '192w42', '194w41', '194w42', '195w4', '196w4', '197w4',
+                                         '191w5', '192w51', '192w52', '194w51', '194w52', '195w5', '196w5', '197w5'),
+                       ('300w', '300f', '300m', '300w4', '300w5')),
+}
+
+
+def extract_comments(response):
+    """Returns the response_comments columns for a survey response, or None if it has no survey_id and period to
+    file them under.  Every response gets a row, with a null comment if the respondent left none, so that exports
+    can count the responses to a survey period too
+    """
+    survey_id = response.get('survey_id')
+    collection = response.get('collection')
+    period = collection.get('period') if isinstance(collection, dict) else None
+    if not isinstance(survey_id, str) or not isinstance(period, str):
+        return None
+
+    metadata = response.get('metadata')
+    ru_ref = metadata.get('ru_ref') if isinstance(metadata, dict) else None
+    answers = response.get('data')
+    if not isinstance(answers, dict):
+        answers = {}
+
+    rule = COMMENT_RULES.get(survey_id, DEFAULT_RULE)
+    comment = answers.get(rule.comment)
+    return {'survey_id': survey_id,
+            'period': period,
+            'ru_ref': ru_ref if isinstance(ru_ref, str) else None,
+            'comment': str(comment) if comment else None,
+            'boxes_selected': [qcode for qcode in rule.checkboxes if qcode in answers],
+            'additional': {qcode: answers[qcode] for qcode in rule.additional if qcode in answers}}
+
+
+def save_comments(statement=None, where=None):
+    """An INSERT into response_comments that replaces the row of a response that already has one, if where allows.
+    statement is the insert to start from, such as one from a select
+    """
+    statement = insert(response_comments) if statement is None else statement
+    return statement.on_conflict_do_update(
+        index_elements=[response_comments.c.tx_id],
+        set_={column.name: statement.excluded[column.name] for column in response_comments.columns if column.name != 'tx_id'},
+        where=where)
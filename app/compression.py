@@ -0,0 +1,212 @@
+import json
+import threading
+import time
+import zlib
+from collections import Counter
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm.attributes import flag_modified, set_committed_value
+
+from app import db
+from app.models import SurveyResponse, response_dictionaries
+import settings
+
+# Fields kept in the data column when a response is compressed, so that the indexes and queries on them keep working
+PROMOTED_FIELDS = (('tx_id',), ('type',), ('survey_id',), ('version',), ('submitted_at',),
+                   ('collection', 'period'), ('collection', 'instrument_id'), ('metadata', 'ru_ref'))
+
+# zlib only looks back this far, so any more of a dictionary is never used
+MAX_DICTIONARY_SIZE = 32768
+
+
+def encode(data):
+    """The bytes of data that are compressed.  Keys are sorted so every response of a survey is laid out alike"""
+    return json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def compress(document, dictionary, level=zlib.Z_DEFAULT_COMPRESSION):
+    # Raw deflate, as the zlib header and checksum would be the same few bytes on every row
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    return compressor.compress(document) + compressor.flush()
+
+
+def decompress(body, dictionary):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary)
+    return decompressor.decompress(body) + decompressor.flush()
+
+
+def promote(data):
+    """Returns the PROMOTED_FIELDS of data, nested as they are in it"""
+    promoted = {}
+    for path in PROMOTED_FIELDS:
+        value = data
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            continue
+        target = promoted
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
+    return promoted
+
+
+def fragments(value, found):
+    """Adds the text of each "key": and "key":value in value to found, as encode() writes them"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            prefix = json.dumps(key) + ':'
+            found.add(prefix)
+            if isinstance(item, dict):
+                found.add(prefix + '{')
+            elif isinstance(item, list):
+                found.add(prefix + '[')
+            else:
+                found.add(prefix + json.dumps(item))
+            fragments(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            fragments(item, found)
+
+
+def train(samples, size=MAX_DICTIONARY_SIZE):
+    """Returns a dictionary for compressing responses like samples.  It is made of the keys and key/value pairs
+    found in more than one sample, those saving the most bytes across the samples first.  The most common go
+    at the end, as zlib encodes matches nearer the data in fewer bits
+    """
+    counts = Counter()
+    for sample in samples:
+        found = set()
+        fragments(sample, found)
+        counts.update(found)
+
+    chosen = []
+    used = 0
+    for fragment, count in sorted(counts.items(), key=lambda item: item[1] * len(item[0]), reverse=True):
+        if count > 1 and used + len(fragment) <= size:
+            chosen.append(fragment)
+            used += len(fragment)
+
+    # A key is already in the dictionary as the start of its key/value pair
+    chosen.sort()
+    chosen = [fragment for fragment, following in zip(chosen, chosen[1:] + [''])
+              if not following.startswith(fragment)]
+    chosen.sort(key=lambda fragment: counts[fragment])
+    return ''.join(chosen).encode('utf-8')
+
+
+def add_dictionary(conn, survey_id, dictionary, samples):
+    """Stores dictionary as the next version of survey_id's and returns its id"""
+    version = conn.scalar(select([func.coalesce(func.max(response_dictionaries.c.version), 0) + 1])
+                          .where(response_dictionaries.c.survey_id == survey_id))
+    return conn.scalar(response_dictionaries.insert()
+                       .values(survey_id=survey_id, version=version, dictionary=dictionary, samples=samples)
+                       .returning(response_dictionaries.c.id))
+
+
+class Dictionaries:
+    """Per-process cache of the response_dictionaries table on the primary.  Dictionaries never change once
+    stored, so each is fetched once, when first needed.  The newest version for each survey, used for writes,
+    is looked for again every refresh seconds
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.compressed = 0
+        self.original_bytes = 0
+        self.stored_bytes = 0
+        self._dictionaries = {}
+        self._current = {}
+        self._last_id = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def current(self, survey_id):
+        """Returns (id, dictionary) for the newest of survey_id's dictionaries, or None if it has none"""
+        self._refresh()
+        dictionary_id = self._current.get(survey_id)
+        return (dictionary_id, self.get(dictionary_id)) if dictionary_id else None
+
+    def get(self, dictionary_id):
+        dictionary = self._dictionaries.get(dictionary_id)
+        if dictionary is None:
+            with db.engine.connect() as conn:
+                dictionary = conn.scalar(select([response_dictionaries.c.dictionary])
+                                         .where(response_dictionaries.c.id == dictionary_id))
+            if dictionary is None:
+                raise KeyError(f"No compression dictionary with id {dictionary_id}")
+            dictionary = self._dictionaries[dictionary_id] = bytes(dictionary)
+        return dictionary
+
+    def _refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.refresh:
+                return
+            with db.engine.connect() as conn:
+                rows = conn.execute(select([response_dictionaries.c.id, response_dictionaries.c.survey_id])
+                                    .where(response_dictionaries.c.id > self._last_id)
+                                    .order_by(response_dictionaries.c.id)).fetchall()
+            # Versions are added in order, so the highest id is the newest
+            for row in rows:
+                self._current[row.survey_id] = row.id
+                self._last_id = row.id
+            self._checked_at = now
+
+    def status(self):
+        return {'enabled': settings.COMPRESS_RESPONSES,
+                'surveys': len(self._current),
+                'compressed': self.compressed,
+                'ratio': round(self.stored_bytes / self.original_bytes, 3) if self.original_bytes else None}
+
+
+dictionaries = Dictionaries(settings.COMPRESSION_DICTIONARY_REFRESH)
+
+
+def pack(data):
+    """Returns the data, body and dictionary_id columns to store a response as.  With compressed storage on and a
+    dictionary trained for its survey, body holds the whole response compressed and data only its promoted fields
+    """
+    survey_id = data.get('survey_id')
+    current = dictionaries.current(survey_id) if settings.COMPRESS_RESPONSES and isinstance(survey_id, str) else None
+    if current is None:
+        return {'data': data, 'body': None, 'dictionary_id': None}
+
+    dictionary_id, dictionary = current
+    document = encode(data)
+    body = compress(document, dictionary, settings.COMPRESSION_LEVEL)
+    dictionaries.compressed += 1
+    dictionaries.original_bytes += len(document)
+    dictionaries.stored_bytes += len(body)
+    return {'data': promote(data), 'body': body, 'dictionary_id': dictionary_id}
+
+
+def unpack_text(body, dictionary_id):
+    """Returns the JSON text of a compressed response"""
+    return decompress(body, dictionaries.get(dictionary_id)).decode('utf-8')
+
+
+def unpack(data, body, dictionary_id):
+    """Returns the whole response stored as data, body and dictionary_id"""
+    return data if body is None else json.loads(unpack_text(body, dictionary_id))
+
+
+@event.listens_for(SurveyResponse, 'load')
+@event.listens_for(SurveyResponse, 'refresh')
+def unpack_loaded(target, context, attrs=None):
+    """Responses loaded through the ORM have all of their data, compressed or not"""
+    if attrs is not None and 'data' not in attrs:
+        return
+    # merge() fires load for the new object it makes of a response that isn't stored yet, which is still packed
+    if inspect(target).key is None:
+        return
+    # Read from __dict__, as an attribute not loaded yet would be fetched from inside this event
+    if target.__dict__.get('body') is not None:
+        set_committed_value(target, 'data', unpack(target.data, target.body, target.dictionary_id))
+
+
+@event.listens_for(SurveyResponse, 'before_update')
+def write_data_with_body(mapper, connection, target):
+    """data and body are written together, or uncompressing a loaded response would leave only the promoted fields"""
+    if inspect(target).attrs.body.history.has_changes():
+        flag_modified(target, 'data')
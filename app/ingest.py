@@ -0,0 +1,146 @@
+import codecs
+import json
+import re
+from json.decoder import scanstring
+
+from flask import current_app
+
+from app.exceptions import InvalidUsageError
+from app.validation import check_content_length, check_envelope, raise_too_deep, raise_too_large
+import settings
+
+# Bytes read from the request at a time
+CHUNK_SIZE = 64 * 1024
+
+# Bytes read before checking the envelope fields that have been read, and deciding whether to read on
+ENVELOPE_PREFIX_BYTES = 64 * 1024
+
+# Top level fields checked as soon as they are read
+ENVELOPE_FIELDS = frozenset(('tx_id', 'type', 'metadata', 'invalid'))
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def read_submission(request):
+    """Reads and decodes the body of a POST /responses a piece at a time.  The body is read in chunks and rejected
+    as soon as it passes MAX_PAYLOAD_BYTES, whether or not the client sent a Content-Length.  Envelope fields that
+    come whole in the first ENVELOPE_PREFIX_BYTES are checked before any more is read, so a submission that can't be
+    stored is usually turned away without buffering the rest of it.  Envelope fields after that, behind a large data
+    say, are only checked once the whole body is in memory, so for them the size limit is the only bound.  The body
+    is then decoded a top level field at a time, with the envelope fields checked as each is decoded, so a bad one is
+    rejected before the rest of the body is turned into objects.
+
+    Unlike request.get_json() nothing is cached on the request, so the body and its text are freed on return and
+    aren't held while the response is saved
+    """
+    check_content_length(request.content_length)
+    decoder = current_app.json_decoder()
+    body = read_body(request.stream, settings.MAX_PAYLOAD_BYTES, lambda prefix: check_prefix(prefix, decoder))
+    try:
+        text = body.decode(json.detect_encoding(body))
+    except UnicodeDecodeError:
+        raise_bad_request(request)
+    del body
+    return parse_submission(text, decoder, request)
+
+
+def read_body(stream, limit, check_prefix=None):
+    """Reads stream up to limit bytes, passing the first ENVELOPE_PREFIX_BYTES read to check_prefix before reading
+    on.  A body shorter than that is returned without being passed to it, as there is nothing more to read and it is
+    checked whole when it is parsed
+    """
+    body = bytearray()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return body
+        checked = len(body) >= ENVELOPE_PREFIX_BYTES
+        body += chunk
+        if len(body) > limit:
+            raise_too_large()
+        if check_prefix and not checked and len(body) >= ENVELOPE_PREFIX_BYTES:
+            check_prefix(bytes(body))
+
+
+def check_prefix(prefix, decoder):
+    """Checks the envelope fields that come whole in prefix, the start of a body whose rest hasn't been read.
+    Anything that can't be decoded is left for parse_submission, as it may only be cut off
+    """
+    try:
+        text = codecs.getincrementaldecoder(json.detect_encoding(prefix))().decode(prefix)
+        index = skip(text, 0)
+        if not text.startswith('{', index):
+            return
+        submission = {}
+        for key, value in fields(text, index, decoder):
+            submission[key] = value
+            if key in ENVELOPE_FIELDS:
+                check_envelope(submission, complete=False)
+    except (ValueError, RecursionError):
+        return
+
+
+def parse_submission(text, decoder, request):
+    """Decodes text as JSON one top level field at a time.  Anything but an object is decoded whole and left for
+    validate_submission to reject
+    """
+    index = skip(text, 0)
+    try:
+        if not text.startswith('{', index):
+            return decoder.decode(text)
+
+        submission = {}
+        for key, value in fields(text, index, decoder):
+            submission[key] = value
+            if key in ENVELOPE_FIELDS:
+                check_envelope(submission, complete=False)
+        return submission
+    except ValueError:
+        raise_bad_request(request)
+    except RecursionError:
+        # Nested deeper than the decoder can go, so far deeper than MAX_PAYLOAD_DEPTH
+        raise_too_deep()
+
+
+def fields(text, index, decoder):
+    """Yields the key and value of each top level field of the JSON object starting at index, in order.  A field is
+    only yielded once the ',' or '}' after it has been seen, so that a number cut off at the end of a prefix never
+    is.  Raises ValueError where text stops being an object, and if anything follows it
+    """
+    index = skip(text, index + 1)
+    if text.startswith('}', index):
+        end(text, index + 1)
+        return
+
+    while True:
+        if not text.startswith('"', index):
+            raise ValueError("Expecting a key", index)
+        key, index = scanstring(text, index + 1)
+        index = skip(text, index)
+        if not text.startswith(':', index):
+            raise ValueError("Expecting ':'", index)
+        value, index = decoder.raw_decode(text, skip(text, index + 1))
+
+        index = skip(text, index)
+        if text.startswith(',', index):
+            yield key, value
+            index = skip(text, index + 1)
+        elif text.startswith('}', index):
+            end(text, index + 1)
+            yield key, value
+            return
+        else:
+            raise ValueError("Expecting ',' or '}'", index)
+
+
+def skip(text, index):
+    return WHITESPACE.match(text, index).end()
+
+
+def end(text, index):
+    if skip(text, index) != len(text):
+        raise ValueError("Extra data", index)
+
+
+def raise_bad_request(request):
+    raise InvalidUsageError("Invalid POST request to /response", status_code=400, payload=request.args)
@@ -0,0 +1,139 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+
+import structlog
+from structlog import wrap_logger
+from structlog.stdlib import filter_by_level
+
+import settings
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without ever blocking the caller.  If the listener
+    falls behind and the queue fills up, records are dropped and counted instead.
+
+    Records are queued as they are; formatting happens in the listener thread.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.queued = 0
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.queued += 1
+
+
+class EventSampler:
+    """structlog processor that only lets through a fraction of the debug and info events
+    configured in LOGGING_SAMPLE_RATES.  Warnings and errors are never sampled.
+    """
+
+    sampled_levels = ('debug', 'info')
+
+    def __init__(self, rates):
+        self.rates = rates
+        self.sampled_out = 0
+
+    def __call__(self, logger, method_name, event_dict):
+        rate = self.rates.get(event_dict.get('event'))
+        if rate is not None and method_name in self.sampled_levels and random.random() >= rate:
+            self.sampled_out += 1
+            raise structlog.DropEvent
+        return event_dict
+
+
+class LazyEvent:
+    """Defers rendering a structlog event until the stdlib record is formatted, which
+    happens in the listener thread rather than the thread that logged it
+    """
+
+    __slots__ = ('renderer', 'logger', 'method_name', 'event_dict', 'rendered')
+
+    def __init__(self, renderer, logger, method_name, event_dict):
+        self.renderer = renderer
+        self.logger = logger
+        self.method_name = method_name
+        self.event_dict = event_dict
+        self.rendered = None
+
+    def __str__(self):
+        # Renderers consume the event dict, so render once however many handlers format the record
+        if self.rendered is None:
+            self.rendered = self.renderer(self.logger, self.method_name, self.event_dict)
+        return self.rendered
+
+
+class LazyRenderer:
+    """Final structlog processor that passes a LazyEvent to the stdlib logger as its message"""
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+
+    def __call__(self, logger, method_name, event_dict):
+        return (LazyEvent(self.renderer, logger, method_name, event_dict),), {}
+
+
+def parse_sample_rates(value):
+    """Parses 'event one=0.1,event two=0.01' into {'event one': 0.1, 'event two': 0.01}"""
+    rates = {}
+    for item in filter(None, value.split(',')):
+        event, _, rate = item.rpartition('=')
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+sampler = EventSampler(parse_sample_rates(settings.LOGGING_SAMPLE_RATES))
+queue_handler = NonBlockingQueueHandler(queue.Queue(settings.LOGGING_QUEUE_SIZE))
+listener = None
+
+
+def configure_logging():
+    """Sends every record through a bounded queue to a background thread that does the formatting and I/O,
+    and returns the structlog logger used by the service.  Events below the enabled level are dropped before
+    any processing is done.
+    """
+    global listener
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(settings.LOGGING_FORMAT, datefmt="%Y-%m-%dT%H:%M:%S"))
+
+    root = logging.getLogger()
+    root.setLevel(settings.LOGGING_LEVEL)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # structlog's default chain, with the level check and sampling first and the rendering deferred
+    processors = [
+        filter_by_level,
+        sampler,
+        structlog.processors.StackInfoRenderer(),
+        structlog.dev.set_exc_info,
+        structlog.processors.format_exc_info,
+        structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M.%S", utc=False),
+        LazyRenderer(structlog.dev.ConsoleRenderer()),
+    ]
+    return wrap_logger(logging.getLogger('app'), processors=processors)
+
+
+def log_stats():
+    return {
+        'queued': queue_handler.queued,
+        'waiting': queue_handler.queue.qsize(),
+        'dropped': queue_handler.dropped,
+        'sampled_out': sampler.sampled_out,
+    }
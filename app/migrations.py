@@ -0,0 +1,354 @@
+import time
+
+from sqlalchemy import func, select, text
+
+from app import logger
+from app.models import schema_migrations
+
+# Key for the advisory lock that stops two processes applying migrations at once
+MIGRATION_LOCK = 5704036
+
+
+# Keeps latest_responses pointing at the newest response for each (survey_id, period, ru_ref).  It runs in the
+# transaction that writes the response, whichever way it is written.  When the keys of the response a row points at
+# change, the row is pointed at the newest of the others left, if there are any.  Deletes are handled once per
+# statement, by REPOINT_LATEST_RESPONSES
+MAINTAIN_LATEST_RESPONSES = """
+CREATE OR REPLACE FUNCTION maintain_latest_responses() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND
+            (OLD.data->>'survey_id', OLD.data->'collection'->>'period', OLD.data->'metadata'->>'ru_ref') IS DISTINCT FROM
+            (NEW.data->>'survey_id', NEW.data->'collection'->>'period', NEW.data->'metadata'->>'ru_ref') THEN
+        DELETE FROM latest_responses
+        WHERE survey_id = OLD.data->>'survey_id' AND period = OLD.data->'collection'->>'period'
+          AND ru_ref = OLD.data->'metadata'->>'ru_ref' AND tx_id = OLD.tx_id;
+        IF FOUND THEN
+            INSERT INTO latest_responses (survey_id, period, ru_ref, tx_id, submitted_at, ts)
+            SELECT data->>'survey_id', data->'collection'->>'period', data->'metadata'->>'ru_ref', tx_id,
+                   data->>'submitted_at', ts
+            FROM responses
+            WHERE data->>'survey_id' = OLD.data->>'survey_id' AND data->'collection'->>'period' = OLD.data->'collection'->>'period'
+              AND data->'metadata'->>'ru_ref' = OLD.data->'metadata'->>'ru_ref'
+            ORDER BY data->>'submitted_at' DESC NULLS LAST, ts DESC NULLS LAST
+            LIMIT 1
+            ON CONFLICT (survey_id, period, ru_ref) DO NOTHING;
+        END IF;
+    END IF;
+
+    IF NEW.data->>'survey_id' IS NOT NULL AND NEW.data->'collection'->>'period' IS NOT NULL
+            AND NEW.data->'metadata'->>'ru_ref' IS NOT NULL THEN
+        INSERT INTO latest_responses AS latest (survey_id, period, ru_ref, tx_id, submitted_at, ts)
+        VALUES (NEW.data->>'survey_id', NEW.data->'collection'->>'period', NEW.data->'metadata'->>'ru_ref', NEW.tx_id,
+                NEW.data->>'submitted_at', NEW.ts)
+        ON CONFLICT (survey_id, period, ru_ref) DO UPDATE
+        SET tx_id = excluded.tx_id, submitted_at = excluded.submitted_at, ts = excluded.ts
+        WHERE latest.tx_id = excluded.tx_id
+           OR (coalesce(excluded.submitted_at, ''), coalesce(excluded.ts, '-infinity'))
+              >= (coalesce(latest.submitted_at, ''), coalesce(latest.ts, '-infinity'));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+# Run once for each DELETE from responses, with the deleted rows as old_responses.  Rows of latest_responses that
+# pointed at one of them are removed, then each reporting unit left without one is pointed at the newest of its
+# responses left, in one query however many rows the DELETE removed
+REPOINT_LATEST_RESPONSES = """
+CREATE OR REPLACE FUNCTION repoint_latest_responses() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM latest_responses AS latest
+    USING old_responses AS deleted
+    WHERE latest.survey_id = deleted.data->>'survey_id' AND latest.period = deleted.data->'collection'->>'period'
+      AND latest.ru_ref = deleted.data->'metadata'->>'ru_ref' AND latest.tx_id = deleted.tx_id;
+
+    INSERT INTO latest_responses (survey_id, period, ru_ref, tx_id, submitted_at, ts)
+    SELECT DISTINCT ON (unit.survey_id, unit.period, unit.ru_ref)
+           unit.survey_id, unit.period, unit.ru_ref, r.tx_id, r.data->>'submitted_at', r.ts
+    FROM (SELECT DISTINCT data->>'survey_id' AS survey_id, data->'collection'->>'period' AS period,
+                          data->'metadata'->>'ru_ref' AS ru_ref
+          FROM old_responses) AS unit
+    JOIN responses AS r
+      ON r.data->>'survey_id' = unit.survey_id AND r.data->'collection'->>'period' = unit.period
+     AND r.data->'metadata'->>'ru_ref' = unit.ru_ref
+    WHERE NOT EXISTS (SELECT 1 FROM latest_responses AS latest
+                      WHERE latest.survey_id = unit.survey_id AND latest.period = unit.period
+                        AND latest.ru_ref = unit.ru_ref)
+    ORDER BY unit.survey_id, unit.period, unit.ru_ref, r.data->>'submitted_at' DESC NULLS LAST, r.ts DESC NULLS LAST
+    ON CONFLICT (survey_id, period, ru_ref) DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+class Index:
+    """An index a migration builds with CREATE INDEX CONCURRENTLY, so it can be applied to a live database
+    without blocking writes to the table
+    """
+
+    def __init__(self, name, table, definition, unique=False):
+        self.name = name
+        self.table = table
+        self.definition = definition
+        self.unique = unique
+
+    def create_statement(self):
+        unique = "UNIQUE " if self.unique else ""
+        return f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {self.name} ON {self.table} {self.definition}"
+
+
+class Migration:
+    """A versioned schema change.  Statements are run in one transaction, then backfills, then indexes are built
+    one at a time outside of it.  Statements should be safe to run against a database that db.create_all()
+    has already brought up to date.  Each backfill is an UPDATE of at most a batch of rows, run in transactions of
+    its own until it updates none, so that filling in a new column never locks the whole table for long.  A
+    primary_only migration changes tables that aren't sharded, and is only recorded as applied on the other shards
+    """
+
+    def __init__(self, version, description, statements=(), indexes=(), primary_only=False, backfills=()):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.backfills = backfills
+        self.indexes = indexes
+        self.primary_only = primary_only
+
+
+# Most rows a backfill updates in one transaction
+BACKFILL_BATCH_SIZE = 10000
+
+MIGRATIONS = [
+    # Adding a column with a volatile default such as nextval() rewrites the table under an ACCESS EXCLUSIVE lock.
+    # So the columns are added without one, which only changes the catalog, the defaults are set for rows written
+    # from then on, and the rows already there are filled in by a backfill before the index is built
+    Migration(1, "Add change feed columns to responses",
+              statements=[
+                  "CREATE SEQUENCE IF NOT EXISTS responses_seq",
+                  "ALTER TABLE responses ADD COLUMN IF NOT EXISTS seq bigint",
+                  "ALTER TABLE responses ADD COLUMN IF NOT EXISTS write_txid bigint",
+                  "ALTER TABLE responses ALTER COLUMN seq SET DEFAULT nextval('responses_seq')",
+                  "ALTER TABLE responses ALTER COLUMN write_txid SET DEFAULT txid_current()",
+              ],
+              backfills=[
+                  "UPDATE responses SET seq = nextval('responses_seq'), write_txid = txid_current() "
+                  "WHERE tx_id IN (SELECT tx_id FROM responses WHERE seq IS NULL "
+                  f"LIMIT {BACKFILL_BATCH_SIZE} FOR UPDATE SKIP LOCKED)",
+              ],
+              indexes=[
+                  Index('ix_responses_seq', 'responses', '(seq)'),
+              ]),
+    Migration(2, "Add indexes for retention, invalid responses and survey and period lookups",
+              indexes=[
+                  # DELETE /responses/old
+                  Index('ix_responses_ts', 'responses', '(ts)'),
+                  # GET /invalid-responses.  Invalid responses are rare, so this stays small
+                  Index('ix_responses_invalid_ts', 'responses', '(ts) WHERE invalid'),
+                  # Scripts that select a survey's responses for a period, e.g. export_comments
+                  Index('ix_responses_survey_period', 'responses',
+                        "((data->>'survey_id'), (data->'collection'->>'period'))"),
+              ]),
+    # response_dictionaries lives on the primary only and is made by db.create_all()
+    Migration(3, "Add compressed body columns to responses",
+              statements=[
+                  "ALTER TABLE responses ADD COLUMN IF NOT EXISTS body bytea",
+                  "ALTER TABLE responses ADD COLUMN IF NOT EXISTS dictionary_id integer",
+              ]),
+    # Run scripts/rebuild_latest_responses.py to fill in latest_responses for responses saved before this was applied
+    Migration(4, "Maintain the latest response for each reporting unit",
+              statements=[
+                  "CREATE TABLE IF NOT EXISTS latest_responses ("
+                  "survey_id text NOT NULL, period text NOT NULL, ru_ref text NOT NULL, tx_id uuid NOT NULL, "
+                  "submitted_at text, ts timestamp with time zone, "
+                  "PRIMARY KEY (survey_id, period, ru_ref))",
+                  MAINTAIN_LATEST_RESPONSES,
+                  "DROP TRIGGER IF EXISTS responses_latest ON responses",
+                  "CREATE TRIGGER responses_latest AFTER INSERT OR UPDATE OR DELETE ON responses "
+                  "FOR EACH ROW EXECUTE PROCEDURE maintain_latest_responses()",
+              ]),
+    # Only feedback saved from now on has its tx_id set.  Run scripts/dedup_feedback.py to set it on older feedback,
+    # removing any retried copies
+    Migration(5, "Add tx_id to feedback responses",
+              statements=[
+                  "ALTER TABLE feedback_responses ADD COLUMN IF NOT EXISTS tx_id uuid",
+              ],
+              indexes=[
+                  # Makes saving feedback idempotent, with INSERT ... ON CONFLICT (tx_id)
+                  Index('ix_feedback_responses_tx_id', 'feedback_responses', '(tx_id)', unique=True),
+              ],
+              primary_only=True),
+    Migration(6, "Index responses in change feed order",
+              indexes=[
+                  # GET /responses/changes reads on from a (write_txid, seq) position
+                  Index('ix_responses_write_txid_seq', 'responses', '(write_txid, seq)'),
+              ]),
+    # Deleting responses one row at a time looked up each one's reporting unit again, so deleting many was
+    # quadratic.  They are now repointed once per statement, and each unit's responses found by index
+    Migration(7, "Repoint the latest responses once per delete",
+              statements=[
+                  MAINTAIN_LATEST_RESPONSES,
+                  REPOINT_LATEST_RESPONSES,
+                  "DROP TRIGGER IF EXISTS responses_latest ON responses",
+                  "CREATE TRIGGER responses_latest AFTER INSERT OR UPDATE ON responses "
+                  "FOR EACH ROW EXECUTE PROCEDURE maintain_latest_responses()",
+                  "DROP TRIGGER IF EXISTS responses_latest_delete ON responses",
+                  "CREATE TRIGGER responses_latest_delete AFTER DELETE ON responses "
+                  "REFERENCING OLD TABLE AS old_responses "
+                  "FOR EACH STATEMENT EXECUTE PROCEDURE repoint_latest_responses()",
+              ],
+              indexes=[
+                  # Finding a reporting unit's responses when the one latest_responses points at is deleted or moved
+                  Index('ix_responses_survey_period_ru_ref', 'responses',
+                        "((data->>'survey_id'), (data->'collection'->>'period'), (data->'metadata'->>'ru_ref'))"),
+              ]),
+    # Saving a response writes its comments here.  Run scripts/backfill_comments.py to fill it in for responses saved
+    # before this was applied
+    Migration(8, "Add response comments",
+              statements=[
+                  "CREATE TABLE IF NOT EXISTS response_comments ("
+                  "survey_id text NOT NULL, period text NOT NULL, "
+                  "tx_id uuid NOT NULL UNIQUE REFERENCES responses (tx_id) ON DELETE CASCADE, "
+                  "ru_ref text, comment text, boxes_selected text[] NOT NULL, additional jsonb NOT NULL, "
+                  "ts timestamp with time zone DEFAULT now(), "
+                  "PRIMARY KEY (survey_id, period, tx_id))",
+              ]),
+]
+
+# Indexes on these tables that no migration defines are reported by check_indexes() if they are never used
+TABLES = ('responses', 'feedback_responses')
+
+INDEX_STATE = text("""
+SELECT c.relname AS name, i.indisvalid AS valid, i.indisunique AS is_unique, s.idx_scan AS scans,
+       pg_relation_size(c.oid) AS size, t.relname AS table
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+JOIN pg_class t ON t.oid = i.indrelid
+JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+WHERE t.relname = ANY(:tables)
+""")
+
+
+def expected_indexes(primary=True):
+    return [index for migration in MIGRATIONS if primary or not migration.primary_only for index in migration.indexes]
+
+
+def applied_versions(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    return {row.version for row in conn.execute(select([schema_migrations.c.version]))}
+
+
+def pending_migrations(conn):
+    """Returns the migrations that have not been applied to the database conn is connected to"""
+    applied = applied_versions(conn)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def unapplied_versions(conn):
+    """Returns the versions of the migrations not applied to the database conn is connected to.  Unlike
+    pending_migrations it only reads, for checking a database that the service itself doesn't migrate
+    """
+    if conn.scalar(select([func.to_regclass('schema_migrations')])) is None:
+        applied = set()
+    else:
+        applied = {row.version for row in conn.execute(select([schema_migrations.c.version]))}
+    return [migration.version for migration in MIGRATIONS if migration.version not in applied]
+
+
+def apply_migrations(engine, primary=True):
+    """Applies any pending migrations, in order, and returns them.  Indexes that applied migrations define but
+    that are missing or invalid are built again too.  Holds an advisory lock throughout, so that processes
+    starting together with CREATE_TABLES set don't both apply them.  primary is False for shards other than the primary
+    """
+    with engine.connect() as conn:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        # Poll rather than block for the lock.  A waiting session would hold a snapshot that the other
+        # session's concurrent index builds have to wait for
+        while not conn.scalar(select([func.pg_try_advisory_lock(MIGRATION_LOCK)])):
+            time.sleep(1)
+
+        try:
+            pending = pending_migrations(conn)
+            for migration in pending:
+                apply_migration(engine, conn, migration, primary)
+
+            state = index_state(conn)
+            for index in expected_indexes(primary):
+                if not state.get(index.name, {}).get('valid'):
+                    build_index(conn, index)
+            return pending
+        finally:
+            conn.scalar(select([func.pg_advisory_unlock(MIGRATION_LOCK)]))
+
+
+def apply_migration(engine, conn, migration, primary=True):
+    if migration.primary_only and not primary:
+        conn.execute(schema_migrations.insert().values(version=migration.version, description=migration.description))
+        return
+
+    logger.info("Applying migration", version=migration.version, description=migration.description)
+
+    if migration.statements:
+        with engine.begin() as transaction:
+            for statement in migration.statements:
+                transaction.execute(text(statement))
+
+    for backfill in migration.backfills:
+        run_backfill(engine, backfill)
+
+    for index in migration.indexes:
+        build_index(conn, index)
+
+    conn.execute(schema_migrations.insert().values(version=migration.version, description=migration.description))
+
+
+def run_backfill(engine, statement):
+    started = time.monotonic()
+    updated = 0
+    while True:
+        with engine.begin() as transaction:
+            rows = transaction.execute(text(statement)).rowcount
+        if not rows:
+            break
+        updated += rows
+    logger.info("Backfilled rows", rows=updated, seconds=round(time.monotonic() - started, 3))
+
+
+def build_index(conn, index):
+    # A concurrent build that failed leaves an invalid index behind, which IF NOT EXISTS would keep
+    state = index_state(conn).get(index.name)
+    if state is not None and not state['valid']:
+        logger.warning("Rebuilding invalid index", index=index.name)
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+
+    started = time.monotonic()
+    conn.execute(text(index.create_statement()))
+    logger.info("Built index", index=index.name, seconds=round(time.monotonic() - started, 3))
+
+
+def index_state(conn):
+    return {row.name: dict(row) for row in conn.execute(INDEX_STATE, tables=list(TABLES))}
+
+
+def check_indexes(conn, primary=True):
+    """Compares the indexes on the live database with the ones migrations define.  Returns a list of
+    problems, each a dict with the index name, the problem ('missing', 'invalid' or 'unused') and a detail.
+    Unused means not scanned since statistics were last reset, and is only reported for indexes that
+    aren't backing a primary key or unique constraint
+    """
+    state = index_state(conn)
+    problems = []
+
+    for index in expected_indexes(primary):
+        if index.name not in state:
+            problems.append({'index': index.name, 'problem': 'missing', 'detail': index.create_statement()})
+        elif not state[index.name]['valid']:
+            problems.append({'index': index.name, 'problem': 'invalid',
+                             'detail': "A concurrent build failed"})
+
+    for name, row in sorted(state.items()):
+        if row['valid'] and not row['is_unique'] and row['scans'] == 0:
+            problems.append({'index': name, 'problem': 'unused',
+                             'detail': f"No scans of {row['table']} through it, {row['size']} bytes"})
+    return problems
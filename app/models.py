@@ -1,8 +1,10 @@
-from sqlalchemy import Integer, String
-from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy import BigInteger, Integer, LargeBinary, String, Text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID
 
 from app import db
 
+responses_seq = db.Sequence('responses_seq')
+
 
 # pylint: disable=maybe-no-member
 class SurveyResponse(db.Model):
@@ -22,16 +24,42 @@ class SurveyResponse(db.Model):
 
     data = db.Column("data", JSONB)
 
-    def __init__(self, tx_id, invalid, data):
+    # With compressed storage the whole response is held here, compressed with the response_dictionaries entry
+    # dictionary_id, and data only keeps the fields in app.compression.PROMOTED_FIELDS.  Both are null otherwise
+    body = db.Column("body", LargeBinary)
+
+    dictionary_id = db.Column("dictionary_id", Integer)
+
+    # Write sequence used by the change feed.  Bumped on every insert and update
+    seq = db.Column("seq",
+                    BigInteger,
+                    responses_seq,
+                    server_default=responses_seq.next_value(),
+                    onupdate=responses_seq.next_value(),
+                    index=True)
+
+    # Id of the transaction that last wrote the row, so that the change feed only hands out
+    # rows once every transaction that could have taken an earlier seq has finished
+    write_txid = db.Column("write_txid",
+                           BigInteger,
+                           server_default=db.func.txid_current(),
+                           onupdate=db.func.txid_current())
+
+    # Columns returned by the API.  The rest are bookkeeping
+    api_columns = ('tx_id', 'ts', 'invalid', 'data')
+
+    def __init__(self, tx_id, invalid, data, body=None, dictionary_id=None):
         self.tx_id = tx_id
         self.invalid = invalid
         self.data = data
+        self.body = body
+        self.dictionary_id = dictionary_id
 
     def __repr__(self):
         return '<SurveyResponse {}>'.format(self.tx_id)
 
     def to_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name in self.api_columns}
 
 
 class FeedbackResponse(db.Model):
@@ -53,8 +81,58 @@ class FeedbackResponse(db.Model):
     survey = db.Column("survey", String(length=25))
     period = db.Column("period", String(length=25))
 
-    def __init__(self, invalid, data, survey, period):
+    # The submission's tx_id, so that a retried submission is stored once.  Feedback without one is stored every time
+    tx_id = db.Column("tx_id", UUID, index=True, unique=True)
+
+    def __init__(self, invalid, data, survey, period, tx_id=None):
         self.invalid = invalid
         self.data = data
         self.survey = survey
         self.period = period
+        self.tx_id = tx_id
+
+
+# Versions of app.migrations applied to the database
+schema_migrations = db.Table("schema_migrations",
+                             db.Column("version", Integer, primary_key=True),
+                             db.Column("description", Text),
+                             db.Column("applied_at", db.TIMESTAMP(timezone=True), server_default=db.func.now()))
+
+
+# Compression dictionaries trained on each survey's responses by scripts/train_dictionaries.py.  Rows are never
+# changed once written, and a new version is added to retrain
+response_dictionaries = db.Table("response_dictionaries",
+                                 db.Column("id", Integer, primary_key=True),
+                                 db.Column("survey_id", String(length=25), nullable=False),
+                                 db.Column("version", Integer, nullable=False),
+                                 db.Column("dictionary", LargeBinary, nullable=False),
+                                 db.Column("samples", Integer),
+                                 db.Column("created_at", db.TIMESTAMP(timezone=True), server_default=db.func.now()),
+                                 db.UniqueConstraint("survey_id", "version"))
+
+
+# The newest response to each survey period from each reporting unit, kept up to date by the trigger that
+# app.migrations adds to responses.  Newest is by the submitted_at the response gives, then by when it was saved.
+# Each shard has its own, covering the responses stored on it
+latest_responses = db.Table("latest_responses",
+                            db.Column("survey_id", Text, primary_key=True),
+                            db.Column("period", Text, primary_key=True),
+                            db.Column("ru_ref", Text, primary_key=True),
+                            db.Column("tx_id", UUID, nullable=False),
+                            db.Column("submitted_at", Text),
+                            db.Column("ts", db.TIMESTAMP(timezone=True)))
+
+
+# Each response's comment and the boxes ticked with it, taken out of the response by app.comments as it is saved, so
+# that exporting a survey period's comments reads this rather than every response.  ts is the response's, and
+# rows go when their response is deleted.  Each shard has its own, covering the responses stored on it
+response_comments = db.Table("response_comments",
+                             db.Column("survey_id", Text, primary_key=True),
+                             db.Column("period", Text, primary_key=True),
+                             db.Column("tx_id", UUID, db.ForeignKey("responses.tx_id", ondelete="CASCADE"),
+                                       primary_key=True, unique=True),
+                             db.Column("ru_ref", Text),
+                             db.Column("comment", Text),
+                             db.Column("boxes_selected", ARRAY(Text), nullable=False),
+                             db.Column("additional", JSONB, nullable=False),
+                             db.Column("ts", db.TIMESTAMP(timezone=True), server_default=db.func.now()))
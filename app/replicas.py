@@ -0,0 +1,112 @@
+import itertools
+import threading
+import time
+
+from flask import _app_ctx_stack
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from app import logger
+
+# Seconds since the replica last replayed a transaction from the primary, or 0 if it isn't a replica at all.
+# An idle primary makes this grow too, which only means reads go to the (idle) primary for a while
+LAG_QUERY = text("SELECT CASE WHEN pg_is_in_recovery() "
+                 "THEN COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+                 "ELSE 0 END")
+
+CHECK_TIMEOUT = text("SELECT set_config('statement_timeout', :timeout, true)")
+
+
+class Replica:
+    def __init__(self, uri, timeout):
+        # So that a replica that has gone away fails reads and health checks quickly, rather than after TCP gives up
+        self.engine = create_engine(uri, pool_pre_ping=True, connect_args={'connect_timeout': timeout})
+        self.session = scoped_session(sessionmaker(bind=self.engine, query_cls=BaseQuery),
+                                      scopefunc=_app_ctx_stack.__ident_func__)
+        self.timeout = timeout
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+
+    def check(self, max_lag):
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(CHECK_TIMEOUT, timeout=str(self.timeout * 1000))
+                self.lag = float(conn.scalar(LAG_QUERY))
+            self.healthy = self.lag <= max_lag
+        except SQLAlchemyError as e:
+            logger.error("Replica health check failed", replica=repr(self.engine.url), error=e)
+            self.lag = None
+            self.healthy = False
+        self.checked_at = time.monotonic()
+
+    def status(self):
+        return {'uri': repr(self.engine.url), 'healthy': self.healthy, 'lag': self.lag}
+
+
+class ReplicaSet:
+    """Read replicas that reads which can tolerate some lag are spread across.  Each replica is health
+    checked every check_interval seconds by a background thread, and one that can't be reached within timeout
+    seconds or is more than max_lag seconds behind is skipped until it recovers.  Requests only read the result of
+    the last check, so never wait on one.  Until a replica's first check it is skipped, and when no replica is
+    usable, callers fall back to the primary.
+    """
+
+    def __init__(self, uris, max_lag, check_interval, timeout):
+        self.replicas = [Replica(uri, timeout) for uri in uris]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._next = itertools.count()
+        self._checker = None
+        self._start_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def init_app(self, app):
+        app.teardown_appcontext(self.remove)
+
+    def start(self):
+        """Start the health checking thread if it isn't already running"""
+        with self._start_lock:
+            if not self.replicas or self._stopped.is_set():
+                return
+            if self._checker is None or not self._checker.is_alive():
+                self._checker = threading.Thread(target=self._run, name="replica-checker", daemon=True)
+                self._checker.start()
+
+    def stop(self):
+        """Stops health checking for good, after any check in progress"""
+        self._stopped.set()
+
+    def choose(self):
+        """Returns a replica that was healthy when last checked, or None if reads should go to the primary"""
+        self.start()
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._next) % len(self.replicas)]
+            if replica.healthy:
+                return replica
+        return None
+
+    def failed(self, replica, error):
+        """Takes a replica out of rotation until its next health check after a query on it failed"""
+        logger.error("Read from replica failed, falling back to primary", replica=repr(replica.engine.url), error=error)
+        replica.session.rollback()
+        replica.healthy = False
+
+    def check(self):
+        """Health checks every replica in turn"""
+        for replica in self.replicas:
+            replica.check(self.max_lag)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.check_interval)
+
+    def remove(self, exception=None):
+        for replica in self.replicas:
+            replica.session.remove()
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
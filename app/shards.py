@@ -0,0 +1,177 @@
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import _app_ctx_stack
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import create_engine, delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from app import db, logger
+from app.admission import current_route_class, working_for
+from app.changes import ChangeListeners
+from app.comments import save_comments
+from app.models import SurveyResponse, latest_responses, response_comments, schema_migrations
+import settings
+
+# Tables that are spread over the shards.  Everything else lives on shard 0, the primary
+SHARDED_TABLES = [SurveyResponse.__table__, latest_responses, response_comments, schema_migrations]
+
+
+def shard_for(tx_id, count):
+    """Returns the number of the shard out of count that tx_id belongs on.  The same in every process"""
+    if count == 1:
+        return 0
+    digest = hashlib.blake2b(uuid.UUID(str(tx_id)).bytes, digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+class Shard:
+    """One of the databases responses are spread over.  Shard 0 is the primary database and uses db's engine and
+    session, the others have their own
+    """
+
+    def __init__(self, number, uri=None):
+        self.number = number
+        if uri is None:
+            self._engine = None
+            self.session = db.session
+        else:
+            self._engine = create_engine(uri, pool_pre_ping=True)
+            self.session = scoped_session(sessionmaker(bind=self._engine, query_cls=BaseQuery),
+                                          scopefunc=_app_ctx_stack.__ident_func__)
+
+    @property
+    def engine(self):
+        return self._engine if self._engine is not None else db.engine
+
+    def status(self):
+        return {'shard': self.number, 'uri': repr(self.engine.url)}
+
+
+class ShardSet:
+    """Spreads responses over the primary database and any number of others by a hash of their tx_id.
+
+    Anything that reads or writes one tx_id goes to the shard it belongs on.  Anything that covers every
+    response, like list pages and retention, is run on all the shards at once with scatter() and the results
+    combined.  With no other shards configured the primary is the only shard and nothing changes.  Changing
+    the number of shards changes where most tx_ids belong, so rebalance() must be run afterwards, with
+    SHARDS_REBALANCING set until it has finished so that reads look for responses on their old shards.
+    """
+
+    def __init__(self, uris):
+        self.shards = [Shard(0)] + [Shard(number, uri) for number, uri in enumerate(uris, 1)]
+        # Writes are notified on the database they are made on, so the change feed listens to every shard
+        self.listeners = ChangeListeners([settings.DB_URI] + list(uris), settings.CHANGE_FEED_CHANNEL)
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard') \
+            if self.sharded else None
+
+    @property
+    def sharded(self):
+        return len(self.shards) > 1
+
+    def init_app(self, app):
+        app.teardown_appcontext(self.remove)
+
+    def for_tx_id(self, tx_id):
+        return self.shards[shard_for(tx_id, len(self.shards))]
+
+    def group(self, tx_ids):
+        """Returns {shard: [tx_id]} for the shards that tx_ids belong on"""
+        groups = {}
+        for tx_id in tx_ids:
+            groups.setdefault(self.for_tx_id(tx_id), []).append(tx_id)
+        return groups
+
+    def elsewhere(self, tx_ids):
+        """Returns {shard: [tx_id]} for the shards other than the one they belong on that tx_ids may still be on,
+        which is all of them while SHARDS_REBALANCING is set and none otherwise
+        """
+        groups = {}
+        if self.sharded and settings.SHARDS_REBALANCING:
+            for shard in self.shards:
+                misplaced = [tx_id for tx_id in tx_ids if self.for_tx_id(tx_id) is not shard]
+                if misplaced:
+                    groups[shard] = misplaced
+        return groups
+
+    def scatter(self, func):
+        """Calls func with each shard, in parallel, and returns the results in shard order.  func runs outside the
+        request's thread, so it must use shard.engine rather than shard.session.  Transactions it begins get the
+        timeouts of the request's route class
+        """
+        if not self.sharded:
+            return [func(self.shards[0])]
+
+        route_class = current_route_class()
+
+        def call(shard):
+            with working_for(route_class):
+                return func(shard)
+        return list(self._executor.map(call, self.shards))
+
+    def remove(self, exception=None):
+        for shard in self.shards[1:]:
+            shard.session.remove()
+
+    def status(self):
+        return [shard.status() for shard in self.shards]
+
+    def rebalance(self, batch_size=1000, dry_run=False):
+        """Moves every response that is on the wrong shard to the one it belongs on, and returns
+        {(from, to): count}.  Each batch is copied to its new shard and committed before it is deleted from the old
+        one, so a response is never missing from both.  Where the new shard already has the tx_id, the newer
+        of the two is kept.  Comments move with their responses
+        """
+        moved = {}
+        for source in self.shards:
+            after = None
+            while True:
+                query = select([SurveyResponse.tx_id, SurveyResponse.ts, SurveyResponse.invalid, SurveyResponse.data,
+                                SurveyResponse.body, SurveyResponse.dictionary_id]) \
+                    .order_by(SurveyResponse.tx_id) \
+                    .limit(batch_size)
+                if after is not None:
+                    query = query.where(SurveyResponse.tx_id > after)
+                with source.engine.connect() as conn:
+                    rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                after = rows[-1].tx_id
+
+                for target, tx_ids in self.group(row.tx_id for row in rows).items():
+                    if target is source:
+                        continue
+                    moved[(source.number, target.number)] = moved.get((source.number, target.number), 0) + len(tx_ids)
+                    if not dry_run:
+                        wanted = set(tx_ids)
+                        self._move(source, target, [dict(row) for row in rows if row.tx_id in wanted])
+        return moved
+
+    @staticmethod
+    def _move(source, target, rows):
+        statement = insert(SurveyResponse.__table__)
+        statement = statement.on_conflict_do_update(
+            index_elements=[SurveyResponse.tx_id],
+            set_={'ts': statement.excluded.ts, 'invalid': statement.excluded.invalid, 'data': statement.excluded.data,
+                  'body': statement.excluded.body, 'dictionary_id': statement.excluded.dictionary_id},
+            where=SurveyResponse.ts < statement.excluded.ts)
+        tx_ids = [row['tx_id'] for row in rows]
+        with source.engine.connect() as conn:
+            comments = [dict(row) for row in conn.execute(select([response_comments])
+                                                          .where(response_comments.c.tx_id.in_(tx_ids)))]
+
+        with target.engine.begin() as conn:
+            conn.execute(statement, rows)
+            # Comments have their response's ts, so the same ones are kept
+            if comments:
+                comments_statement = insert(response_comments)
+                conn.execute(save_comments(comments_statement, where=response_comments.c.ts < comments_statement.excluded.ts),
+                             comments)
+
+        # Deleting the responses deletes their comments
+        with source.engine.begin() as conn:
+            conn.execute(delete(SurveyResponse.__table__)
+                         .where(SurveyResponse.tx_id.in_(tx_ids)))
+        logger.info("Moved responses between shards", source=source.number, target=target.number, count=len(rows))
@@ -0,0 +1,195 @@
+import collections
+import datetime
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+from flask.json import JSONDecoder, JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from app import logger
+from app.admission import LOCK_NOT_AVAILABLE
+import settings
+
+# Longest statement text kept in a record.  Parameters are never kept, as they hold survey data
+MAX_STATEMENT_LENGTH = 1000
+
+
+class Trace:
+    """What one request spent its time on.  Times are in seconds"""
+
+    def __init__(self, max_statements):
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.max_statements = max_statements
+        self.statements = []
+        self.dropped = 0
+        self.sql = 0.0
+        self.json_encode = 0.0
+        self.json_decode = 0.0
+        self.pool_wait = 0.0
+        self.lock_timeouts = 0
+
+    def statement(self, statement, duration, rows=None, error=None):
+        self.sql += duration
+        if len(self.statements) >= self.max_statements:
+            self.dropped += 1
+            return
+        entry = {'sql': statement[:MAX_STATEMENT_LENGTH], 'ms': ms(duration), 'rows': rows}
+        if error:
+            entry['error'] = error
+        self.statements.append(entry)
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def current_trace():
+    return g.get('slow_log_trace') if has_app_context() else None
+
+
+class SlowRequestLog:
+    """Records what requests that take longer than threshold_ms spent their time on: every SQL statement run
+    from the request's thread with its duration and row count, JSON encoding and decoding, and waits for a pooled
+    connection.  Each slow request is logged as one event and the last size are kept for /admin/slow-requests.
+
+    Statements run for the request on other threads, such as the per-shard queries of ShardSet.scatter(), aren't
+    listed, though the time waiting for them is in the request's total.  Time a statement spends waiting for a row
+    or table lock is in its duration, and statements ended by lock_timeout are counted.
+    """
+
+    def __init__(self, threshold_ms, size, max_statements):
+        self.threshold = threshold_ms / 1000
+        self.max_statements = max_statements
+        self.recorded = 0
+        self._records = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Must be called before the app's engine is first used, for its pool to be timed"""
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})['poolclass'] = TimedQueuePool
+        app.json_encoder = TimedJSONEncoder
+        app.json_decoder = TimedJSONDecoder
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if not getattr(view, 'slow_log_exempt', False):
+            g.slow_log_trace = Trace(self.max_statements)
+
+    def finish(self, response):
+        trace = g.pop('slow_log_trace', None)
+        if trace is None:
+            return response
+
+        duration = time.perf_counter() - trace.started
+        if duration >= self.threshold:
+            record = {'route': request.url_rule.rule if request.url_rule else None,
+                      'method': request.method,
+                      'status': response.status_code,
+                      'tx_id': (request.view_args or {}).get('tx_id') or g.get('tx_id'),
+                      'route_class': g.get('route_class'),
+                      'started_at': trace.started_at.isoformat(),
+                      'ms': ms(duration),
+                      'sql_ms': ms(trace.sql),
+                      'json_encode_ms': ms(trace.json_encode),
+                      'json_decode_ms': ms(trace.json_decode),
+                      'pool_wait_ms': ms(trace.pool_wait),
+                      'lock_timeouts': trace.lock_timeouts,
+                      'statements': trace.statements,
+                      'statements_dropped': trace.dropped}
+            with self._lock:
+                self._records.append(record)
+                self.recorded += 1
+            logger.warning("Slow request", **record)
+        return response
+
+    def records(self):
+        """The kept records, newest first"""
+        with self._lock:
+            return list(reversed(self._records))
+
+    def status(self):
+        return {'threshold_ms': ms(self.threshold), 'recorded': self.recorded, 'kept': len(self._records)}
+
+
+def not_recorded(view):
+    """Marks a view that is slow on purpose, like a long-poll, so it never goes in the slow request log"""
+    view.slow_log_exempt = True
+    return view
+
+
+slow_log = SlowRequestLog(settings.SLOW_REQUEST_THRESHOLD, settings.SLOW_REQUEST_LOG_SIZE,
+                          settings.SLOW_REQUEST_MAX_STATEMENTS)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that adds the time taken to check out a connection, waiting for one to be returned or opening a
+    new one, to the current request's trace
+    """
+
+    def connect(self):
+        trace = current_trace()
+        if trace is None:
+            return super().connect()
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            trace.pool_wait += time.perf_counter() - started
+
+
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        trace = current_trace()
+        if trace is None:
+            return super().encode(o)
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            trace.json_encode += time.perf_counter() - started
+
+
+class TimedJSONDecoder(JSONDecoder):
+    # decode() calls raw_decode(), which submissions are also decoded with a field at a time
+    def raw_decode(self, s, *args, **kwargs):
+        trace = current_trace()
+        if trace is None:
+            return super().raw_decode(s, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().raw_decode(s, *args, **kwargs)
+        finally:
+            trace.json_decode += time.perf_counter() - started
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_trace() is not None:
+        context.slow_log_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'slow_log_started', None)
+    trace = current_trace()
+    if started is not None and trace is not None:
+        trace.statement(statement, time.perf_counter() - started, cursor.rowcount)
+
+
+@event.listens_for(Engine, 'handle_error')
+def failed_statement(context):
+    started = getattr(context.execution_context, 'slow_log_started', None)
+    trace = current_trace()
+    if started is None or trace is None:
+        return
+    pgcode = getattr(context.original_exception, 'pgcode', None)
+    if pgcode == LOCK_NOT_AVAILABLE:
+        trace.lock_timeouts += 1
+    trace.statement(context.statement or '', time.perf_counter() - started,
+                    error=pgcode or type(context.original_exception).__name__)
@@ -0,0 +1,226 @@
+import fcntl
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from app import logger
+
+# Each record is the length and crc32 of its data, then the data, which is JSON
+RECORD_HEADER = struct.Struct('>II')
+
+
+class Journal:
+    """Append-only file of checksummed records, plus a sidecar file holding the offset that has been replayed.
+    A journal is only used by the process holding its flock, so one left by a worker that died can be
+    claimed and drained by another
+    """
+
+    def __init__(self, path, fd):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self.fd = fd
+        self.offset = self._read_offset()
+        self.end = self.offset
+        self.depth = 0
+        self.corrupt = 0
+        self.lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._written = 0
+        self._synced = 0
+
+        for next_offset, record in self._records(self.offset):
+            self.end = next_offset
+            if record is not None:
+                self.depth += 1
+        # A record cut short by a crash was never acknowledged, so it is dropped
+        os.ftruncate(self.fd, self.end)
+
+    @classmethod
+    def claim(cls, path):
+        """Returns the journal at path, created if need be, or None if another process holds it"""
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return cls(path, fd)
+
+    def append(self, data):
+        """Writes a record and returns once it, and anything written before it, is on disk.  Writers that arrive
+        while an fsync is running share the next one
+        """
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.lock:
+            os.write(self.fd, record)
+            self.end += len(record)
+            self.depth += 1
+            self._written += 1
+            position = self._written
+
+        with self._sync_lock:
+            if self._synced >= position:
+                return
+            with self.lock:
+                target = self._written
+            os.fsync(self.fd)
+            self._synced = target
+
+    def read_batch(self, size):
+        """Returns ([record], offset after them) for up to size records after the replayed offset"""
+        with self.lock:
+            end = self.end
+        records = []
+        offset = self.offset
+        for next_offset, record in self._records(self.offset, end):
+            offset = next_offset
+            if record is not None:
+                records.append(record)
+                if len(records) >= size:
+                    break
+        return records, offset
+
+    def advance(self, offset, count):
+        """Marks the records before offset as replayed.  Once everything has been the file is emptied"""
+        with self.lock:
+            self.depth -= count
+            if offset == self.end:
+                os.ftruncate(self.fd, 0)
+                os.fsync(self.fd)
+                self.end = offset = 0
+            self.offset = offset
+            self._write_offset(offset)
+
+    def remove(self):
+        for path in (self.offset_path, self.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        os.close(self.fd)
+
+    def _records(self, offset, end=None):
+        """Yields (offset after the record, record), with None for a record that fails its checksum"""
+        if end is None:
+            end = os.fstat(self.fd).st_size
+        while offset + RECORD_HEADER.size <= end:
+            length, crc = RECORD_HEADER.unpack(os.pread(self.fd, RECORD_HEADER.size, offset))
+            if offset + RECORD_HEADER.size + length > end:
+                return
+            data = os.pread(self.fd, length, offset + RECORD_HEADER.size)
+            offset += RECORD_HEADER.size + length
+            if zlib.crc32(data) != crc:
+                logger.error("Skipping spooled record that failed its checksum", journal=self.path, offset=offset)
+                self.corrupt += 1
+                yield offset, None
+            else:
+                yield offset, json.loads(data)
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        temp_path = self.offset_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.offset_path)
+
+
+class Spool:
+    """Local write-ahead spool for submissions that couldn't be saved because the database was unavailable.
+
+    Each process appends to its own journal in directory, and a background thread replays it in batches of
+    batch_size once the database is back, along with any journal that no running process holds.  replay is
+    called with a list of records and must be idempotent, as a batch is replayed again if the process dies
+    before recording that it was done.
+    """
+
+    def __init__(self, directory, batch_size, interval):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.interval = interval
+        self.journal = None
+        self.spooled = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._replayer = None
+
+    def open(self):
+        with self._lock:
+            if self.journal is not None:
+                return self.journal
+
+            os.makedirs(self.directory, exist_ok=True)
+            n = 0
+            while self.journal is None:
+                self.journal = Journal.claim(os.path.join(self.directory, f'journal-{n}'))
+                n += 1
+            logger.info("Opened spool journal", journal=self.journal.path, depth=self.journal.depth)
+            return self.journal
+
+    def append(self, record):
+        self.open().append(json.dumps(record).encode('utf-8'))
+        self.spooled += 1
+
+    def start(self, replay):
+        """Starts replaying spooled records in a background thread"""
+        self.open()
+        with self._lock:
+            if self._replayer is not None:
+                return
+            self._replayer = threading.Thread(target=self._run, args=(replay,), name="spool-replayer", daemon=True)
+        self._replayer.start()
+
+    def _run(self, replay):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.drain(replay)
+            except Exception as e:
+                logger.error("Could not replay spool, will retry", error=e)
+
+    def drain(self, replay):
+        """Replays this process's journal, then any journal left by a process that has gone"""
+        self._drain_journal(self.open(), replay)
+
+        for path in sorted(glob.glob(os.path.join(self.directory, 'journal-*[0-9]'))):
+            if path == self.journal.path:
+                continue
+            journal = Journal.claim(path)
+            if journal is None:
+                continue
+            logger.info("Replaying orphaned spool journal", journal=path, depth=journal.depth)
+            try:
+                self._drain_journal(journal, replay)
+            except Exception:
+                os.close(journal.fd)
+                raise
+            journal.remove()
+
+    def _drain_journal(self, journal, replay):
+        while True:
+            records, offset = journal.read_batch(self.batch_size)
+            if not records:
+                if offset != journal.offset:
+                    journal.advance(offset, 0)
+                return
+            replay(records)
+            journal.advance(offset, len(records))
+            self.replayed += len(records)
+            logger.info("Replayed spooled responses", count=len(records), depth=journal.depth)
+
+    def status(self):
+        return {'depth': self.journal.depth if self.journal else 0,
+                'spooled': self.spooled,
+                'replayed': self.replayed,
+                'corrupt': self.journal.corrupt if self.journal else 0}
@@ -0,0 +1,35 @@
+from sqlalchemy.engine import Connection
+
+
+class StatementCache(dict):
+    """Compiled SQL for the statements the busiest routes run, keyed as SQLAlchemy keys its compiled_cache: by
+    dialect, statement and the names of the parameters given.  The statements are built once at import, so there is
+    one entry per statement and set of parameters for each database, and it never needs evicting
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        compiled = super().get(key, default)
+        if compiled is default:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return compiled
+
+    def status(self):
+        return {'statements': len(self), 'hits': self.hits, 'misses': self.misses}
+
+
+statement_cache = StatementCache()
+
+
+def execute(connectable, statement, params=None):
+    """Runs statement on a session's connection, or on a connection, compiling it only the first time.  After that
+    each execution only binds params to the cached SQL.  In a session it runs in the session's transaction
+    """
+    conn = connectable if isinstance(connectable, Connection) else connectable.connection()
+    return conn.execution_options(compiled_cache=statement_cache).execute(statement, params or {})
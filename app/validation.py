@@ -0,0 +1,90 @@
+import re
+
+from app.exceptions import InvalidUsageError
+import settings
+
+UUID_PATTERN = re.compile(r'\A[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+
+# Postgres jsonb rejects NUL, and lone surrogates can't be encoded as UTF-8 at all
+FORBIDDEN_CHARACTERS = re.compile('[\x00\ud800-\udfff]')
+
+
+def is_feedback(survey_response):
+    return str(survey_response.get('type')).find("feedback") != -1
+
+
+def check_content_length(content_length):
+    """Rejects a request body that is bigger than we are prepared to store before it is read"""
+    if content_length is not None and content_length > settings.MAX_PAYLOAD_BYTES:
+        raise_too_large()
+
+
+def validate_submission(survey_response):
+    """Checks everything about a submission that would otherwise only fail once it reached Postgres.
+    Raises an InvalidUsageError with the same message and payload the database failure would have produced
+    """
+    if not isinstance(survey_response, dict):
+        raise InvalidUsageError("Invalid POST request to /response", 400)
+
+    check_envelope(survey_response)
+    check_contents(survey_response)
+
+
+def check_envelope(survey_response, complete=True):
+    """Checks the fields that say what a submission is and who it is from.  With complete False the submission is
+    still being read, so only what is already certain to be wrong is rejected
+    """
+    typed = complete or 'type' in survey_response
+    feedback = is_feedback(survey_response)
+    if typed and not feedback:
+        if (complete or 'metadata' in survey_response) and not isinstance(survey_response.get('metadata'), dict):
+            raise InvalidUsageError("Missing metadata. Unable to save response", 400)
+        if complete and 'tx_id' not in survey_response:
+            raise InvalidUsageError("Missing transaction id. Unable to save response", 400)
+
+    if complete or 'tx_id' in survey_response:
+        tx_id = survey_response.get('tx_id')
+        if (tx_id is not None or (typed and not feedback)) and not (isinstance(tx_id, str) and UUID_PATTERN.match(tx_id)):
+            raise InvalidUsageError("tx_id supplied is not a valid UUID", 400)
+
+
+def check_contents(survey_response):
+    """Walks the payload once without recursion, checking nesting depth and every key and string value"""
+    max_depth = settings.MAX_PAYLOAD_DEPTH
+    search = FORBIDDEN_CHARACTERS.search
+    stack = [(survey_response, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if depth > max_depth:
+            raise_too_deep()
+
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if search(key):
+                    raise_invalid_character()
+                if isinstance(value, str):
+                    if search(value):
+                        raise_invalid_character()
+                elif isinstance(value, (dict, list)):
+                    stack.append((value, depth + 1))
+        else:
+            for value in node:
+                if isinstance(value, str):
+                    if search(value):
+                        raise_invalid_character()
+                elif isinstance(value, (dict, list)):
+                    stack.append((value, depth + 1))
+
+
+def raise_invalid_character():
+    raise InvalidUsageError("Invalid characters in payload", 400, payload={'contains_invalid_character': True})
+
+
+def raise_too_large():
+    raise InvalidUsageError("Payload too large. Unable to save response", 413,
+                            payload={'max_payload_bytes': settings.MAX_PAYLOAD_BYTES})
+
+
+def raise_too_deep():
+    raise InvalidUsageError("Payload nested too deeply. Unable to save response", 400,
+                            payload={'max_payload_depth': settings.MAX_PAYLOAD_DEPTH})
@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.comments import extract_comments, save_comments
+from app.compression import unpack
+from app.models import SurveyResponse, response_comments
+import settings
+
+try:
+    # The primary, then any other shards.  Each has its own response_comments
+    dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+
+def backfill(survey_ids, batch_size):
+    """Writes the response_comments row of every response on every shard, or only those to survey_ids if any are
+    given, a batch at a time in tx_id order.  A batch's responses can't be deleted until its comments are written.
+    A row already written from the response as it is now, or from a newer save, is left alone, so it can run while
+    responses are being saved and be run again
+    """
+    statement = insert(response_comments)
+    statement = save_comments(statement, where=response_comments.c.ts < statement.excluded.ts)
+
+    for number, db in enumerate(dbs):
+        after = None
+        read = written = 0
+        while True:
+            query = select([SurveyResponse.tx_id, SurveyResponse.ts, SurveyResponse.data, SurveyResponse.body,
+                            SurveyResponse.dictionary_id]) \
+                .order_by(SurveyResponse.tx_id) \
+                .limit(batch_size) \
+                .with_for_update(read=True, key_share=True)
+            if survey_ids:
+                query = query.where(SurveyResponse.data['survey_id'].astext.in_(survey_ids))
+            if after is not None:
+                query = query.where(SurveyResponse.tx_id > after)
+
+            with db.begin() as conn:
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                after = rows[-1].tx_id
+
+                comments = []
+                for row in rows:
+                    columns = extract_comments(unpack(row.data, row.body, row.dictionary_id))
+                    if columns:
+                        comments.append(dict(columns, tx_id=row.tx_id, ts=row.ts))
+                if comments:
+                    conn.execute(statement, comments)
+            read += len(rows)
+            written += len(comments)
+        print(f"Shard {number}: brought the comments of {written} of {read} responses up to date")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in response_comments from the stored responses, for responses "
+                                                 "saved before it was added")
+    parser.add_argument('survey_ids', nargs='*', help="Surveys to backfill, all of them if none are given")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Responses read at a time")
+    args = parser.parse_args()
+
+    backfill(args.survey_ids, args.batch_size)
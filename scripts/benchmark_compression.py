@@ -0,0 +1,115 @@
+"""Compares storing responses as plain JSONB against compressed storage with a dictionary trained on the survey's
+responses: the space the responses table takes, and the time to save, read and list them.
+
+Runs against a throwaway database from testing.postgresql, so needs Postgres installed locally.
+"""
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+import testing.postgresql
+
+import settings
+
+ROWS = 2000
+SAMPLES = 500
+READS = 500
+PER_PAGE = 100
+
+WORDS = "the turnover figure was lower this period due to staff holidays and a fall in orders from overseas".split()
+
+
+def make_submission():
+    """A response like a monthly business survey's, with the same qcodes each time and varying answers"""
+    data = {str(qcode): str(random.randint(0, 10 ** random.randint(1, 7))) for qcode in range(11, 60)}
+    data.update({str(qcode): random.choice(['Yes', 'No']) for qcode in range(60, 90)})
+    data['146'] = ' '.join(random.choice(WORDS) for _ in range(random.randint(0, 40)))
+    return {
+        "type": "uk.gov.ons.edc.eq:surveyresponse",
+        "origin": "uk.gov.ons.edc.eq",
+        "survey_id": "009",
+        "version": "0.0.1",
+        "tx_id": str(uuid.uuid4()),
+        "case_id": str(uuid.uuid4()),
+        "collection": {"exercise_sid": str(uuid.uuid4()), "instrument_id": "0255", "period": "201809"},
+        "submitted_at": f"2018-09-{random.randint(1, 28):02}T{random.randint(0, 23):02}:39:40Z",
+        "started_at": f"2018-09-{random.randint(1, 28):02}T{random.randint(0, 23):02}:12:02Z",
+        "metadata": {"user_id": str(random.randint(10 ** 8, 10 ** 9)), "ru_ref": f"{random.randint(10 ** 10, 10 ** 11)}A"},
+        "data": data,
+    }
+
+
+def timed(func, items):
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start) / len(items) * 1000
+
+
+def run(server, rows):
+    """Saves rows then reads them back, returning the sizes and timings"""
+    client = server.app.test_client()
+    with server.db.engine.begin() as conn:
+        conn.execute("TRUNCATE responses CASCADE")
+
+    def save(row):
+        assert client.post('/responses', data=json.dumps(row)).status_code == 200
+
+    def read(row):
+        assert client.get(f"/responses/{row['tx_id']}").status_code == 200
+
+    def list_page(page):
+        assert client.get(f'/responses?per_page={PER_PAGE}&page={page}').status_code == 200
+
+    results = {'save': timed(save, rows),
+               'read': timed(read, random.sample(rows, READS)),
+               'list': timed(list_page, range(1, ROWS // PER_PAGE + 1))}
+    # VACUUM can't run in a transaction
+    with server.db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute("VACUUM ANALYZE responses")
+        results['table'], results['row'] = conn.execute(
+            "SELECT pg_table_size('responses'), "
+            "avg(pg_column_size(data) + coalesce(pg_column_size(body), 0)) FROM responses").first()
+    return results
+
+
+def main():
+    random.seed(0)
+    with testing.postgresql.Postgresql() as postgresql:
+        settings.DB_URI = postgresql.url()
+
+        import server
+        from app import compression
+
+        server.create_tables()
+        rows = [make_submission() for _ in range(ROWS)]
+        samples = [make_submission() for _ in range(SAMPLES)]
+        size = sum(len(compression.encode(row)) for row in rows) / ROWS
+
+        settings.COMPRESS_RESPONSES = False
+        plain = run(server, rows)
+
+        dictionary = compression.train(samples)
+        with server.db.engine.begin() as conn:
+            compression.add_dictionary(conn, '009', dictionary, SAMPLES)
+        settings.COMPRESS_RESPONSES = True
+        compressed = run(server, rows)
+
+        print(f"{ROWS} responses of {size:.0f} bytes on average, dictionary of {len(dictionary)} bytes "
+              f"trained on {SAMPLES} others")
+        print(f"{'':<12}{'table size':>14}{'bytes/row':>12}{'save ms':>10}{'read ms':>10}{'page ms':>10}")
+        for label, results in (('JSONB', plain), ('compressed', compressed)):
+            print(f"{label:<12}{results['table']:>14}{results['row']:>12.0f}{results['save']:>10.2f}"
+                  f"{results['read']:>10.2f}{results['list']:>10.2f}")
+        print(f"Table is {compressed['table'] / plain['table']:.1%} of the size, "
+              f"responses {compressed['row'] / plain['row']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Compares the per-request CPU time of the busiest routes run on the ORM, as they were before, against the cached
+Core statements of app.statements that they run on now: POST /responses, GET /responses/<tx_id> and
+POST /responses/exists.
+
+CPU time is this process's, so it leaves out the time Postgres spends on the statements and only counts what the
+service spends building, compiling and running them, plus the rest of the request.  Runs against a throwaway
+database from testing.postgresql, so needs Postgres installed locally.
+"""
+import json
+import os
+import sys
+import time
+import uuid
+from unittest import mock
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+import testing.postgresql
+
+# Debug logging would take most of each request's time
+os.environ.setdefault('LOGGING_LEVEL', 'WARNING')
+
+import settings
+
+REQUESTS = 2000
+
+SUBMISSION = {
+    "type": "uk.gov.ons.edc.eq:surveyresponse",
+    "origin": "uk.gov.ons.edc.eq",
+    "survey_id": "009",
+    "version": "0.0.1",
+    "collection": {"exercise_sid": "f1a2b3c4", "instrument_id": "0255", "period": "201809"},
+    "submitted_at": "2018-09-06T12:39:40Z",
+    "metadata": {"user_id": "789473423", "ru_ref": "12345678901A"},
+    "data": {str(i): str(i * 7) for i in range(1, 40)},
+}
+
+
+def orm_paths(server):
+    """How the routes saved and read responses before app.statements"""
+    from sqlalchemy import func, select
+    from app.models import SurveyResponse
+
+    def merge(response):
+        session = server.shards.for_tx_id(response['tx_id']).session
+        # Without the comments, which were only extracted once the Core statements came in
+        session.merge(SurveyResponse(**{key: response[key] for key in ('tx_id', 'invalid', 'data', 'body', 'dictionary_id')}))
+        session.execute(select([func.pg_notify(settings.CHANGE_FEED_CHANNEL, response['tx_id'])]))
+        session.commit()
+        server.tx_id_filter.add(response['tx_id'])
+
+    def get_response(tx_id):
+        shard = server.shards.for_tx_id(tx_id)
+        r = SurveyResponse.query.with_session(shard.session()).filter_by(tx_id=tx_id).paginate(1, 100)
+        return r.items[0].data if r.items else None
+
+    def execute(session, statement, params):
+        # Only ever given the tx_ids statement by responses_exist
+        return session.query(SurveyResponse.tx_id).filter(SurveyResponse.tx_id.in_(params['tx_ids'])).all()
+
+    return [mock.patch('server.merge', merge), mock.patch('server.get_response', get_response),
+            mock.patch('server.execute', execute)]
+
+
+def cpu_ms(requests):
+    """Returns the mean CPU milliseconds taken by each of requests, which are called in turn"""
+    start = time.process_time()
+    for request in requests:
+        request()
+    return (time.process_time() - start) / len(requests) * 1000
+
+
+def run(client, tx_ids):
+    def post(tx_id):
+        body = json.dumps(dict(SUBMISSION, tx_id=tx_id))
+        return lambda: client.post('/responses', data=body, content_type='application/json')
+
+    def get(tx_id):
+        return lambda: client.get('/responses/' + tx_id)
+
+    def exists(tx_id):
+        # A tx_id the filter can't rule out, so it is looked up
+        body = json.dumps({'tx_ids': [tx_id]})
+        return lambda: client.post('/responses/exists', data=body)
+
+    return [cpu_ms([route(tx_id) for tx_id in tx_ids]) for route in (post, get, exists)]
+
+
+def main():
+    with testing.postgresql.Postgresql() as postgresql:
+        settings.DB_URI = postgresql.url()
+
+        import server
+
+        server.create_tables()
+        client = server.app.test_client()
+        # Warm up both paths, so that neither pays for connecting or first compiles
+        run(client, [str(uuid.uuid4()) for _ in range(50)])
+        patches = orm_paths(server)
+        for patch in patches:
+            patch.start()
+        run(client, [str(uuid.uuid4()) for _ in range(50)])
+
+        orm = run(client, [str(uuid.uuid4()) for _ in range(REQUESTS)])
+        for patch in patches:
+            patch.stop()
+        core = run(client, [str(uuid.uuid4()) for _ in range(REQUESTS)])
+
+        print(f"{'route':<28}{'ORM ms':>10}{'Core ms':>10}{'saved':>8}")
+        for route, before, after in zip(('POST /responses', 'GET /responses/<tx_id>', 'POST /responses/exists'),
+                                        orm, core):
+            print(f"{route:<28}{before:>10.3f}{after:>10.3f}{1 - after / before:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
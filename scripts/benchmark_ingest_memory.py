@@ -0,0 +1,94 @@
+"""Compares the peak memory of a POST /responses decoded whole with request.get_json() against the incremental
+reading and decoding of app/ingest.py, for submissions with list collectors of increasing size.  Each is measured
+for a submission that is saved and for one rejected for its tx_id.
+
+Peak memory is what tracemalloc sees allocated by Python during the request, not the process RSS, so it leaves out
+the interpreter and anything already loaded.  Runs against a throwaway database from testing.postgresql, so needs
+Postgres installed locally.
+"""
+import io
+import json
+import os
+import random
+import sys
+import tracemalloc
+import uuid
+from unittest import mock
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+import testing.postgresql
+
+import settings
+
+# Answers in each submission's list collector
+SIZES = (1000, 10000, 50000)
+
+
+def make_submission(answers):
+    """A response whose bulk is a list collector, like a survey listing every employee or site"""
+    return {
+        "type": "uk.gov.ons.edc.eq:surveyresponse",
+        "origin": "uk.gov.ons.edc.eq",
+        "survey_id": "009",
+        "version": "0.0.1",
+        "tx_id": str(uuid.uuid4()),
+        "collection": {"exercise_sid": str(uuid.uuid4()), "instrument_id": "0255", "period": "201809"},
+        "submitted_at": "2018-09-06T12:39:40Z",
+        "metadata": {"user_id": "789473423", "ru_ref": "12345678901A"},
+        "data": {"answers": [{"answer_id": f"employee-{i}", "value": str(random.randint(0, 10 ** 6)),
+                              "list_item_id": uuid.uuid4().hex[:6], "group_instance": i} for i in range(answers)]},
+    }
+
+
+def buffered(request):
+    """How submissions were read before app/ingest.py"""
+    return request.get_json(force=True)
+
+
+def peak(client, body):
+    """Returns the status and peak MiB allocated while posting body"""
+    # Read from a buffered stream like a worker's socket, as reading the test client's own BytesIO doesn't copy
+    body = body.encode('utf-8')
+    stream = io.BufferedReader(io.BytesIO(body))
+    tracemalloc.start()
+    try:
+        status = client.post('/responses', input_stream=stream, content_length=len(body)).status_code
+        return status, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    random.seed(0)
+    with testing.postgresql.Postgresql() as postgresql:
+        settings.DB_URI = postgresql.url()
+        settings.MAX_PAYLOAD_BYTES = 100 * 1024 * 1024
+
+        import server
+
+        server.create_tables()
+        client = server.app.test_client()
+
+        print(f"{'answers':>8}{'body MiB':>10}{'':>4}{'get_json':>10}{'incremental':>13}"
+              f"{'':>4}{'get_json':>10}{'incremental':>13}")
+        print(f"{'':>22}{'saved, peak MiB':>23}{'':>4}{'rejected, peak MiB':>23}")
+        for answers in SIZES:
+            submission = make_submission(answers)
+            rejected = dict(submission, tx_id='not-a-uuid')
+            results = []
+            for body in (submission, rejected):
+                for reader in (buffered, server.read_submission):
+                    body['tx_id'] = str(uuid.uuid4()) if body is submission else body['tx_id']
+                    with mock.patch('server.read_submission', reader):
+                        status, used = peak(client, json.dumps(body))
+                    assert status == (200 if body is submission else 400), status
+                    results.append(used)
+            size = len(json.dumps(submission)) / 2 ** 20
+            print(f"{answers:>8}{size:>10.1f}{'':>4}{results[0]:>10.1f}{results[1]:>13.1f}"
+                  f"{'':>4}{results[2]:>10.1f}{results[3]:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Compares the worker CPU used by GET /responses when each response on the page is encoded by Postgres against
+building it from SurveyResponse objects with to_dict() and jsonify, as the endpoint used to.
+
+Runs against a throwaway database from testing.postgresql, so needs Postgres installed locally.
+"""
+import json
+import os
+import sys
+import time
+import uuid
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+import testing.postgresql
+
+import settings
+
+ROWS = 2000
+REQUESTS = 200
+PER_PAGE = 100
+
+
+def make_submission():
+    return {
+        "type": "uk.gov.ons.edc.eq:surveyresponse",
+        "origin": "uk.gov.ons.edc.eq",
+        "survey_id": "009",
+        "version": "0.0.1",
+        "tx_id": str(uuid.uuid4()),
+        "collection": {"exercise_sid": "hfjdskf", "instrument_id": "0255", "period": "201809"},
+        "submitted_at": "2018-09-12T10:39:40Z",
+        "metadata": {"user_id": "789473423", "ru_ref": "12345678901A"},
+        "data": {str(qcode): str(qcode * 7) for qcode in range(1, 150)},
+    }
+
+
+def timed(label, func):
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(REQUESTS):
+        func()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    print(f"{label:<12} {wall / REQUESTS * 1000:8.2f} ms wall {cpu / REQUESTS * 1000:8.2f} ms worker CPU per request")
+    return cpu
+
+
+def main():
+    with testing.postgresql.Postgresql() as postgresql:
+        settings.DB_URI = postgresql.url()
+
+        import server
+        from app.models import SurveyResponse
+
+        server.create_tables()
+        rows = [make_submission() for _ in range(ROWS)]
+        server.db.session.execute(SurveyResponse.__table__.insert(),
+                                  [{'tx_id': row['tx_id'], 'invalid': False, 'data': row} for row in rows])
+        server.db.session.commit()
+
+        client = server.app.test_client()
+        url = f'/responses?per_page={PER_PAGE}'
+
+        def orm_page():
+            with server.app.test_request_context(url):
+                page = SurveyResponse.query.filter_by(invalid=False).paginate(1, PER_PAGE)
+                server.jsonify([item.to_dict() for item in page.items]).get_data()
+            server.db.session.remove()
+
+        def postgres_page():
+            client.get(url).get_data()
+
+        assert len(json.loads(client.get(url).data)) == PER_PAGE
+
+        print(f"{REQUESTS} requests for pages of {PER_PAGE} from {ROWS} responses")
+        orm = timed("ORM", orm_page)
+        postgres = timed("Postgres", postgres_page)
+        print(f"Worker CPU reduced by {(1 - postgres / orm) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
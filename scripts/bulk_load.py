@@ -0,0 +1,203 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import time
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.comments import extract_comments
+from app.exceptions import InvalidUsageError
+from app.shards import shard_for
+from app.validation import is_feedback, validate_submission
+import settings
+
+try:
+    # The primary, then any other shards
+    dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+CREATE_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS bulk_load_staging (line_no bigint, data jsonb, comments jsonb) ON COMMIT DELETE ROWS
+"""
+
+# Python truthiness of the 'invalid' key, as tested by save_response and save_feedback_response
+INVALID = """
+CASE jsonb_typeof(data->'invalid')
+    WHEN 'boolean' THEN (data->>'invalid')::boolean
+    WHEN 'number' THEN (data->>'invalid')::numeric <> 0
+    WHEN 'string' THEN data->>'invalid' <> ''
+    WHEN 'array' THEN data->'invalid' <> '[]'::jsonb
+    WHEN 'object' THEN data->'invalid' <> '{}'::jsonb
+    ELSE false
+END
+"""
+
+IS_FEEDBACK = "strpos(COALESCE(data->>'type', 'None'), 'feedback') > 0"
+
+# The last line in the batch for a tx_id wins, as it would have if they had been POSTed in order, and its comments
+# are written with it
+MERGE_RESPONSES = f"""
+WITH staged AS (
+    SELECT DISTINCT ON (tx_id) tx_id, invalid, CASE WHEN invalid THEN data - 'invalid' ELSE data END AS data, comments
+    FROM (SELECT (data->>'tx_id')::uuid AS tx_id, line_no, {INVALID} AS invalid, data, comments
+          FROM bulk_load_staging
+          WHERE NOT {IS_FEEDBACK}) s
+    ORDER BY tx_id, line_no DESC
+), upserted AS (
+    INSERT INTO responses (tx_id, invalid, data)
+    SELECT tx_id, invalid, data FROM staged
+    ON CONFLICT (tx_id) DO UPDATE
+    SET invalid = EXCLUDED.invalid,
+        data = EXCLUDED.data,
+        body = NULL,
+        dictionary_id = NULL,
+        ts = now(),
+        seq = nextval('responses_seq'),
+        write_txid = txid_current()
+    RETURNING tx_id
+), commented AS (
+    INSERT INTO response_comments (survey_id, period, tx_id, ru_ref, comment, boxes_selected, additional)
+    SELECT comments->>'survey_id', comments->>'period', tx_id, comments->>'ru_ref', comments->>'comment',
+           ARRAY(SELECT jsonb_array_elements_text(comments->'boxes_selected')), comments->'additional'
+    FROM staged
+    WHERE comments IS NOT NULL
+    ON CONFLICT (tx_id) DO UPDATE
+    SET survey_id = EXCLUDED.survey_id,
+        period = EXCLUDED.period,
+        ru_ref = EXCLUDED.ru_ref,
+        comment = EXCLUDED.comment,
+        boxes_selected = EXCLUDED.boxes_selected,
+        additional = EXCLUDED.additional,
+        ts = now()
+)
+SELECT count(pg_notify(%(channel)s, tx_id::text)) FROM upserted
+"""
+
+# Feedback with a tx_id that is already stored, or earlier in the batch, is skipped as POST /responses would
+INSERT_FEEDBACK = f"""
+INSERT INTO feedback_responses (invalid, data, survey, period, tx_id)
+SELECT invalid, CASE WHEN invalid THEN data - 'invalid' ELSE data END, data->>'survey_id', data->'collection'->>'period',
+       (data->>'tx_id')::uuid
+FROM (SELECT {INVALID} AS invalid, data, line_no FROM bulk_load_staging WHERE {IS_FEEDBACK}) s
+ORDER BY line_no
+ON CONFLICT (tx_id) DO NOTHING
+"""
+
+
+def open_input(path):
+    """Opens an NDJSON file for reading as bytes, decompressing it if it is gzipped"""
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if gzipped else open(path, 'rb')
+
+
+def read_batches(f, commit_size):
+    """Yields (lines, offset) where lines is a list of (line_no, submission) and offset is the byte
+    offset just after the batch, to resume from.  Lines that fail validation are reported and skipped
+    """
+    offset = f.tell()
+    batch = []
+    for line_no, line in enumerate(f, 1):
+        offset += len(line)
+        if not line.strip():
+            continue
+        try:
+            submission = json.loads(line)
+            validate_submission(submission)
+        except ValueError as e:
+            print(f"Skipping line {line_no}: {e}")
+            continue
+        except InvalidUsageError as e:
+            print(f"Skipping line {line_no}: {e.message}")
+            continue
+
+        batch.append((line_no, submission))
+        if len(batch) >= commit_size:
+            yield batch, offset
+            batch = []
+    if batch:
+        yield batch, offset
+
+
+def copy_buffer(batch):
+    """Renders a batch in COPY's text format, with the response_comments columns taken out of each response.
+    json.dumps output is ASCII with control characters escaped, so backslashes are the only thing COPY needs escaped
+    """
+    buffer = io.StringIO()
+    for line_no, submission in batch:
+        comments = None if is_feedback(submission) else extract_comments(submission)
+        comments = json.dumps(comments).replace(chr(92), chr(92) * 2) if comments else r'\N'
+        buffer.write(f"{line_no}\t{json.dumps(submission).replace(chr(92), chr(92) * 2)}\t{comments}\n")
+    buffer.seek(0)
+    return buffer
+
+
+def split_by_shard(batch):
+    """Returns a list of the batch's lines for each shard.  Feedback is only kept on the primary"""
+    parts = [[] for _ in dbs]
+    for line_no, submission in batch:
+        shard = 0 if is_feedback(submission) else shard_for(submission['tx_id'], len(dbs))
+        parts[shard].append((line_no, submission))
+    return parts
+
+
+def load(path, commit_size, offset):
+    conns = [db.raw_connection() for db in dbs]
+    started = time.monotonic()
+    loaded = 0
+    try:
+        cursors = [conn.cursor() for conn in conns]
+        for conn, cursor in zip(conns, cursors):
+            cursor.execute(CREATE_STAGING)
+            conn.commit()
+
+        with open_input(path) as f:
+            f.seek(offset)
+            for batch, offset in read_batches(f, commit_size):
+                responses = feedback = 0
+                # The primary is committed last.  It holds the feedback, which is loaded again if it has no tx_id
+                for shard, lines in reversed(list(enumerate(split_by_shard(batch)))):
+                    if not lines:
+                        continue
+                    cursor = cursors[shard]
+                    cursor.copy_expert("COPY bulk_load_staging (line_no, data, comments) FROM STDIN", copy_buffer(lines))
+                    cursor.execute(MERGE_RESPONSES, {'channel': settings.CHANGE_FEED_CHANNEL})
+                    responses += cursor.fetchone()[0]
+                    if shard == 0:
+                        cursor.execute(INSERT_FEEDBACK)
+                        feedback += cursor.rowcount
+                    conns[shard].commit()
+
+                loaded += len(batch)
+                rate = loaded / max(time.monotonic() - started, 0.001)
+                print(f"Committed {responses} responses and {feedback} feedback, {loaded} lines loaded "
+                      f"({rate:.0f}/s). Resume from offset {offset}")
+    except Exception:
+        for conn in conns:
+            conn.rollback()
+        raise
+    finally:
+        for conn in conns:
+            conn.close()
+
+    print(f"Finished loading {loaded} lines from {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load NDJSON submissions (optionally gzipped) into the store")
+    parser.add_argument('path', help="NDJSON file with one submission per line")
+    parser.add_argument('--commit-size', type=int, default=10000, help="Lines loaded per transaction")
+    parser.add_argument('--offset', type=int, default=0,
+                        help="Byte offset (of the uncompressed data) to resume from, as printed after each commit")
+    args = parser.parse_args()
+
+    load(args.path, args.commit_size, args.offset)
@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+import settings
+
+try:
+    # Feedback is only stored on the primary
+    db = create_engine(settings.DB_URI)
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+# The tx_id a feedback row was submitted with, for rows saved before the tx_id column was added
+SUBMITTED_TX_ID = """
+CASE WHEN data->>'tx_id' ~* '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+     THEN CAST(data->>'tx_id' AS uuid) END
+"""
+
+# Stops feedback being saved while duplicates are removed, so none is saved with a tx_id about to be set on an older
+# row.  Reads carry on
+LOCK = text("LOCK TABLE feedback_responses IN SHARE ROW EXCLUSIVE MODE")
+
+COUNT_DUPLICATES = text(f"""
+SELECT count(*) - count(DISTINCT tx_id), count(DISTINCT tx_id) FILTER (WHERE copies > 1)
+FROM (SELECT coalesce(tx_id, {SUBMITTED_TX_ID}) AS tx_id, count(*) OVER (PARTITION BY coalesce(tx_id, {SUBMITTED_TX_ID})) AS copies
+      FROM feedback_responses) f
+WHERE tx_id IS NOT NULL
+""")
+
+# Keeps the first copy of each feedback, whose id was the one handed out first
+DELETE_DUPLICATES = text(f"""
+DELETE FROM feedback_responses f
+USING (SELECT id, row_number() OVER (PARTITION BY coalesce(tx_id, {SUBMITTED_TX_ID}) ORDER BY id) AS copy
+       FROM feedback_responses
+       WHERE coalesce(tx_id, {SUBMITTED_TX_ID}) IS NOT NULL) copies
+WHERE f.id = copies.id AND copies.copy > 1
+""")
+
+SET_TX_IDS = text(f"""
+UPDATE feedback_responses SET tx_id = {SUBMITTED_TX_ID}
+WHERE tx_id IS NULL AND {SUBMITTED_TX_ID} IS NOT NULL
+""")
+
+
+def dedup(dry_run):
+    """Removes all but the first copy of each feedback submitted more than once, and sets tx_id on the feedback
+    saved before it had the column, in one transaction
+    """
+    with db.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(LOCK)
+        duplicates, submissions = conn.execute(COUNT_DUPLICATES).first()
+        print(f"Found {duplicates} duplicate copies of {submissions} feedback submissions")
+        if dry_run:
+            transaction.rollback()
+            return
+
+        deleted = conn.execute(DELETE_DUPLICATES).rowcount
+        updated = conn.execute(SET_TX_IDS).rowcount
+        transaction.commit()
+    print(f"Deleted {deleted} duplicates and set the tx_id of {updated} feedback responses")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove duplicate copies of retried feedback submissions and set the "
+                                                 "tx_id of feedback saved before migration 5")
+    parser.add_argument('--dry-run', action='store_true', help="Count the duplicates without removing them")
+    args = parser.parse_args()
+
+    dedup(args.dry_run)
@@ -1,30 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 import os
-from string import ascii_lowercase
 import sys
 parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(parent_dir_path)
 
 from openpyxl import Workbook
-from sqlalchemy import create_engine
+from sqlalchemy import and_, create_engine, select
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-from app.models import SurveyResponse
+from app.models import response_comments
 import settings
 
 try:
-    db = create_engine(settings.DB_URI)
-    Session = sessionmaker(db)
-    session = Session()
-    base = declarative_base()
+    if settings.DB_SHARD_URIS:
+        # Responses are spread over the shards, so all of them are read
+        dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+    else:
+        # Read only, so use a replica when one is configured
+        dbs = [create_engine((settings.DB_REPLICA_URIS or [settings.DB_URI])[0])]
 except SQLAlchemyError as e:
     print(e)
     raise
 
 
 def create_comments_excel_file(survey_id, period, submissions):
-    """Extract comments from submissions and write them to an excel file"""
+    """Write the comments of submissions, their response_comments rows, to an excel file"""
     print("Generating Excel file")
     workbook = Workbook()
     row = 2
@@ -32,40 +33,18 @@ def create_comments_excel_file(survey_id, period, submissions):
     ws = workbook.active
 
     for submission in submissions:
-        comment = get_comment_text(submission)
-
-        boxes_selected = ""
-        for key in ('146' + letter for letter in ascii_lowercase[0:]):
-            if key in submission.data['data'].keys():
-                boxes_selected = boxes_selected + key + ' '
-
-        if not comment:
+        if not submission.comment:
             continue
         row += 1
         surveys_with_comments_count += 1
-        ws.cell(row, 1, submission.data['metadata']['ru_ref'])
-        ws.cell(row, 2, submission.data['collection']['period'])
+        ws.cell(row, 1, submission.ru_ref)
+        ws.cell(row, 2, submission.period)
+        ws.cell(row, 3, ", ".join(submission.boxes_selected))
+        ws.cell(row, 4, submission.comment)
         if survey_id == '134':
-            if '300w' in submission.data['data']:
-                ws.cell(row, 5, submission.data['data']['300w'])
-            if '300f' in submission.data['data']:
-                ws.cell(row, 6, submission.data['data']['300f'])
-            if '300m' in submission.data['data']:
-                ws.cell(row, 7, submission.data['data']['300m'])
-            if '300w4' in submission.data['data']:
-                ws.cell(row, 8, submission.data['data']['300w4'])
-            if '300w5' in submission.data['data']:
-                ws.cell(row, 9, submission.data['data']['300w5'])
-            checkboxes = ['91w', '92w1', '92w2', '94w1', '94w2', '95w', '96w', '97w',
-                          '91f', '92f1', '92f2', '94f1', '94f2', '95f', '96f', '97f',
-                          '191m', '192m1', '192m2', '194m1', '194m2', '195m', '196m', '197m',
-                          '191w4', '192w41', '192w42', '194w41', '194w42', '195w4', '196w4', '197w4',
-                          '191w5', '192w51', '192w52', '194w51', '194w52', '195w5', '196w5', '197w5']
-            for checkbox in checkboxes:
-                if checkbox in submission.data['data']:
-                    boxes_selected = boxes_selected + f"{checkbox}, "
-        ws.cell(row, 3, boxes_selected)
-        ws.cell(row, 4, comment)
+            for column, qcode in enumerate(('300w', '300f', '300m', '300w4', '300w5'), 5):
+                if qcode in submission.additional:
+                    ws.cell(row, column, submission.additional[qcode])
 
     ws.cell(1, 1, f"Survey ID: {survey_id}")
     ws.cell(1, 2, f"Comments found: {surveys_with_comments_count}")
@@ -85,32 +64,34 @@ def create_comments_excel_file(survey_id, period, submissions):
 
 
 def get_all_submissions(survey_id, period):
-    """Get all submissions that match the survey_id and period supplied"""
+    """Get the comments of all submissions that match the survey_id and period supplied"""
     if survey_id == '181':
         vacancies_records = []
         for survey_id in ['182', '183', '184', '185']:
-            survey_records = session.query(SurveyResponse).filter(SurveyResponse.data['survey_id'].astext == survey_id)
-            period_specific_records = survey_records.filter(SurveyResponse.data['collection']['period'].astext == period).all()
+            period_specific_records = get_submissions(survey_id, period)
             vacancies_records = vacancies_records + period_specific_records
             print(f"Retrieved {len(period_specific_records)} submissions for {survey_id}")
         return vacancies_records
-    survey_records = session.query(SurveyResponse).filter(SurveyResponse.data['survey_id'].astext == survey_id)
-    records = survey_records.filter(SurveyResponse.data['collection']['period'].astext == period).all()
+    records = get_submissions(survey_id, period)
     print(f"Retrieved {len(records)} submissions for {survey_id}")
     return records
 
 
-def get_comment_text(submission):
-    """Returns the respondent typed text from a submission.  The qcode for this text will be different depending
-    on the survey
+def get_submissions(survey_id, period):
+    """Queries the response_comments of every database at once, which app.comments fills in as responses are saved,
+    and merges what they return in the order the responses were stored
     """
-    if submission.data['survey_id'] == '009':
-        return submission.data['data'].get('146')
-    if submission.data['survey_id'] == '187':
-        return submission.data['data'].get('500')
-    if submission.data['survey_id'] == '134':
-        return submission.data['data'].get('300')
-    return submission.data['data'].get('146')
+    query = select([response_comments]) \
+        .where(and_(response_comments.c.survey_id == survey_id, response_comments.c.period == period)) \
+        .order_by(response_comments.c.ts)
+
+    def fetch(db):
+        with db.connect() as conn:
+            return conn.execute(query).fetchall()
+
+    with ThreadPoolExecutor(max_workers=len(dbs)) as executor:
+        results = list(executor.map(fetch, dbs))
+    return list(heapq.merge(*results, key=lambda submission: submission.ts))
 
 
 if __name__ == "__main__":
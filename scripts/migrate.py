@@ -0,0 +1,64 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db as app_db
+from app.migrations import apply_migrations, check_indexes, pending_migrations
+from app.shards import SHARDED_TABLES
+import settings
+
+try:
+    # The primary, then any other shards
+    dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+
+def upgrade():
+    """Creates any tables that don't exist yet, then applies pending migrations, on every shard"""
+    for number, db in enumerate(dbs):
+        app_db.metadata.create_all(db, tables=SHARDED_TABLES if number else None)
+        applied = apply_migrations(db, primary=number == 0)
+        for migration in applied:
+            print(f"Shard {number}: applied {migration.version}: {migration.description}")
+        print(f"Shard {number}: applied {len(applied)} migrations")
+
+
+def check():
+    """Prints pending migrations and index problems on every shard, and returns 1 if anything needs applying"""
+    needs_applying = False
+    for number, db in enumerate(dbs):
+        with db.connect() as conn:
+            pending = pending_migrations(conn)
+            problems = check_indexes(conn, primary=number == 0)
+
+        for migration in pending:
+            print(f"Shard {number}: pending migration {migration.version}: {migration.description}")
+        for problem in problems:
+            print(f"Shard {number}: {problem['problem']:<8} {problem['index']}: {problem['detail']}")
+        needs_applying = needs_applying or pending or any(problem['problem'] != 'unused' for problem in problems)
+
+    if needs_applying:
+        return 1
+    print("Schema is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply or check the store's schema migrations")
+    parser.add_argument('command', choices=['upgrade', 'check'],
+                        help="upgrade applies pending migrations. check reports pending migrations and missing, "
+                             "invalid or unused indexes, exiting non-zero if anything needs applying")
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        upgrade()
+    else:
+        sys.exit(check())
@@ -0,0 +1,27 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from app.shards import ShardSet
+import settings
+
+
+def rebalance(batch_size, dry_run):
+    shards = ShardSet(settings.DB_SHARD_URIS)
+    moved = shards.rebalance(batch_size=batch_size, dry_run=dry_run)
+    for (source, target), count in sorted(moved.items()):
+        print(f"{'Would move' if dry_run else 'Moved'} {count} responses from shard {source} to shard {target}")
+    print(f"{sum(moved.values())} responses {'to move' if dry_run else 'moved'} across {len(shards.shards)} shards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move responses to the shard their tx_id belongs on, after the shards "
+                                                 "in SDX_STORE_POSTGRES_SHARD_URIS have changed")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Responses read from a shard at a time")
+    parser.add_argument('--dry-run', action='store_true', help="Only count the responses that would move")
+    args = parser.parse_args()
+
+    rebalance(args.batch_size, args.dry_run)
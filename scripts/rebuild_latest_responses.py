@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import SQLAlchemyError
+
+import settings
+
+try:
+    # The primary, then any other shards.  Each has its own latest_responses
+    dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+# Rows pointing at a response that is gone, or no longer has the row's keys.  Only left behind by writes that skip
+# the trigger, such as TRUNCATE or restoring a dump
+DELETE_STALE = text("""
+DELETE FROM latest_responses latest
+WHERE (CAST(:survey_id AS text) IS NULL OR latest.survey_id = :survey_id)
+  AND NOT EXISTS (SELECT 1 FROM responses
+                  WHERE responses.tx_id = latest.tx_id
+                    AND responses.data->>'survey_id' = latest.survey_id
+                    AND responses.data->'collection'->>'period' = latest.period
+                    AND responses.data->'metadata'->>'ru_ref' = latest.ru_ref)
+""")
+
+# Points each (survey_id, period, ru_ref) at its newest response, ordered as the trigger orders them.  A row only
+# changes to a newer response, so one the trigger has written since this statement's snapshot is kept
+REBUILD = text("""
+INSERT INTO latest_responses AS latest (survey_id, period, ru_ref, tx_id, submitted_at, ts)
+SELECT DISTINCT ON (1, 2, 3)
+       data->>'survey_id', data->'collection'->>'period', data->'metadata'->>'ru_ref', tx_id, data->>'submitted_at', ts
+FROM responses
+WHERE data->>'survey_id' IS NOT NULL AND data->'collection'->>'period' IS NOT NULL
+  AND data->'metadata'->>'ru_ref' IS NOT NULL
+  AND (CAST(:survey_id AS text) IS NULL OR data->>'survey_id' = :survey_id)
+ORDER BY 1, 2, 3, data->>'submitted_at' DESC NULLS LAST, ts DESC NULLS LAST
+ON CONFLICT (survey_id, period, ru_ref) DO UPDATE
+SET tx_id = excluded.tx_id, submitted_at = excluded.submitted_at, ts = excluded.ts
+WHERE latest.tx_id <> excluded.tx_id
+  AND (coalesce(excluded.submitted_at, ''), coalesce(excluded.ts, '-infinity'))
+      > (coalesce(latest.submitted_at, ''), coalesce(latest.ts, '-infinity'))
+""")
+
+
+def rebuild(survey_ids):
+    """Brings latest_responses on every shard up to date with the responses stored there, one survey per transaction
+    if survey_ids are given, otherwise all of them at once.  Saving responses can carry on while it runs
+    """
+    for number, db in enumerate(dbs):
+        for survey_id in survey_ids or [None]:
+            with db.begin() as conn:
+                stale = conn.execute(DELETE_STALE, survey_id=survey_id).rowcount
+                updated = conn.execute(REBUILD, survey_id=survey_id).rowcount
+            scope = f"survey {survey_id}" if survey_id else "all surveys"
+            print(f"Shard {number}, {scope}: removed {stale} stale and wrote {updated} latest responses")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in or repair the latest response for each reporting unit "
+                                                 "from the stored responses")
+    parser.add_argument('survey_ids', nargs='*', help="Surveys to rebuild, all of them if none are given")
+    args = parser.parse_args()
+
+    rebuild(args.survey_ids)
@@ -9,6 +9,7 @@ from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from app import compression  # noqa: F401 decompresses compressed responses as they are loaded
 from app.models import SurveyResponse
 import settings
 
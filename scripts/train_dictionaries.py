@@ -0,0 +1,148 @@
+import argparse
+import os
+import sys
+
+parent_dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(parent_dir_path)
+
+from sqlalchemy import and_, bindparam, create_engine, func, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.compression import MAX_DICTIONARY_SIZE, add_dictionary, compress, encode, promote, train, unpack
+from app.models import SurveyResponse
+import settings
+
+try:
+    # The primary, then any other shards.  Dictionaries are stored on the primary
+    dbs = [create_engine(uri) for uri in [settings.DB_URI] + settings.DB_SHARD_URIS]
+except SQLAlchemyError as e:
+    print(e)
+    raise
+
+survey_id_column = SurveyResponse.data['survey_id'].astext
+responses = SurveyResponse.__table__
+
+# Rewrites a response compressed, unless it has been saved again since it was read.  ts, seq and write_txid are
+# kept, so the change feed doesn't hand it out again
+COMPRESS_RESPONSE = responses.update() \
+    .where(and_(SurveyResponse.tx_id == bindparam('b_tx_id'), SurveyResponse.seq == bindparam('b_seq'))) \
+    .values(data=bindparam('b_data'), body=bindparam('b_body'), dictionary_id=bindparam('b_dictionary_id'),
+            ts=SurveyResponse.ts, seq=SurveyResponse.seq, write_txid=SurveyResponse.write_txid)
+
+
+def surveys_with_responses(min_samples):
+    counts = {}
+    for db in dbs:
+        with db.connect() as conn:
+            for survey_id, count in conn.execute(select([survey_id_column, func.count()]).group_by(survey_id_column)):
+                if survey_id is not None:
+                    counts[survey_id] = counts.get(survey_id, 0) + count
+    return sorted(survey_id for survey_id, count in counts.items() if count >= min_samples)
+
+
+def sample_responses(survey_id, count):
+    """Returns up to count of the newest responses to survey_id"""
+    query = select([SurveyResponse.ts, SurveyResponse.data, SurveyResponse.body, SurveyResponse.dictionary_id]) \
+        .where(survey_id_column == survey_id) \
+        .order_by(SurveyResponse.ts.desc()) \
+        .limit(count)
+    rows = []
+    for db in dbs:
+        with db.connect() as conn:
+            rows.extend(conn.execute(query).fetchall())
+    rows.sort(key=lambda row: row.ts.timestamp() if row.ts else 0, reverse=True)
+    return [unpack(row.data, row.body, row.dictionary_id) for row in rows[:count]]
+
+
+def evaluate(samples, dictionary):
+    """Returns the mean size of samples as JSON, zlib compressed and compressed with dictionary"""
+    documents = [encode(sample) for sample in samples]
+    sizes = [(len(document), len(compress(document, b'', settings.COMPRESSION_LEVEL)),
+              len(compress(document, dictionary, settings.COMPRESSION_LEVEL))) for document in documents]
+    return [sum(size[i] for size in sizes) / len(sizes) for i in range(3)]
+
+
+def compress_responses(survey_id, dictionary_id, dictionary, batch_size):
+    """Rewrites survey_id's responses that aren't compressed with dictionary_id, a batch at a time.  Returns their
+    total size before and after, as JSON and compressed
+    """
+    original = stored = 0
+    for db in dbs:
+        after = None
+        while True:
+            query = select([SurveyResponse.tx_id, SurveyResponse.seq, SurveyResponse.data, SurveyResponse.body,
+                            SurveyResponse.dictionary_id]) \
+                .where(survey_id_column == survey_id) \
+                .where(or_(SurveyResponse.dictionary_id.is_(None), SurveyResponse.dictionary_id != dictionary_id)) \
+                .order_by(SurveyResponse.tx_id) \
+                .limit(batch_size)
+            if after is not None:
+                query = query.where(SurveyResponse.tx_id > after)
+
+            with db.begin() as conn:
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                after = rows[-1].tx_id
+
+                updates = []
+                for row in rows:
+                    data = unpack(row.data, row.body, row.dictionary_id)
+                    document = encode(data)
+                    body = compress(document, dictionary, settings.COMPRESSION_LEVEL)
+                    original += len(document)
+                    stored += len(body)
+                    updates.append({'b_tx_id': row.tx_id, 'b_seq': row.seq, 'b_data': promote(data), 'b_body': body,
+                                    'b_dictionary_id': dictionary_id})
+                conn.execute(COMPRESS_RESPONSE, updates)
+            print(f"Compressed {len(rows)} responses to survey {survey_id}")
+    return original, stored
+
+
+def train_dictionaries(survey_ids, samples, min_samples, size, compress_existing, batch_size, dry_run):
+    for survey_id in survey_ids or surveys_with_responses(min_samples):
+        found = sample_responses(survey_id, samples)
+        if len(found) < min_samples:
+            print(f"Skipping survey {survey_id}, only {len(found)} responses to sample")
+            continue
+
+        # Every fifth sample is held back to measure the dictionary on
+        held_back = found[::5]
+        dictionary = train([sample for i, sample in enumerate(found) if i % 5], size)
+        json_size, zlib_size, dictionary_size = evaluate(held_back, dictionary)
+        print(f"Survey {survey_id}: {len(dictionary)} byte dictionary from {len(found)} responses. Mean response "
+              f"{json_size:.0f} bytes, {zlib_size:.0f} zlib compressed, {dictionary_size:.0f} with the dictionary")
+        if dry_run:
+            continue
+
+        dictionary = train(found, size)
+        with dbs[0].begin() as conn:
+            dictionary_id = add_dictionary(conn, survey_id, dictionary, len(found))
+        print(f"Stored dictionary {dictionary_id} for survey {survey_id}")
+
+        if compress_existing:
+            original, stored = compress_responses(survey_id, dictionary_id, dictionary, batch_size)
+            if original:
+                print(f"Compressed survey {survey_id}'s responses from {original} to {stored} bytes "
+                      f"({stored / original:.1%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train zlib dictionaries for compressed storage on recent responses "
+                                                 "to each survey")
+    parser.add_argument('survey_ids', nargs='*', help="Surveys to train dictionaries for, all of them if none are given")
+    parser.add_argument('--samples', type=int, default=1000, help="Responses to train each dictionary on")
+    parser.add_argument('--min-samples', type=int, default=100,
+                        help="Fewest responses a survey must have to train a dictionary for it")
+    parser.add_argument('--size', type=int, default=MAX_DICTIONARY_SIZE, help="Largest dictionary to make, in bytes")
+    parser.add_argument('--compress', action='store_true',
+                        help="Also compress each survey's stored responses with its new dictionary")
+    parser.add_argument('--batch-size', type=int, default=1000, help="Responses compressed per transaction")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Report how well dictionaries would compress without storing them")
+    args = parser.parse_args()
+
+    if not 0 < args.size <= MAX_DICTIONARY_SIZE:
+        sys.exit(f"--size must be between 1 and {MAX_DICTIONARY_SIZE}")
+    train_dictionaries(args.survey_ids, args.samples, args.min_samples, args.size, args.compress, args.batch_size,
+                       args.dry_run)
@@ -1,16 +1,37 @@
 import datetime
 import hashlib
+import heapq
+import itertools
+import json
 import os
+import time
 import uuid
 
-from flask import jsonify, request
-from sqlalchemy import inspect, select
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError, DataError
-from voluptuous import All, Coerce, MultipleInvalid, Range, Schema
+from flask import Response, abort, g, jsonify, request, stream_with_context
+from flask import json as flask_json
+from sqlalchemy import String, Text, and_, any_, bindparam, case, cast, delete, false, func, null, select, true, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, UUID, insert
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError, DataError, TimeoutError as PoolTimeoutError
+from voluptuous import All, Coerce, Length, Match, MultipleInvalid, Range, Schema
 from werkzeug.exceptions import BadRequest
 
+from app.admission import admit, controller as admission, shed
+from app.archive import Archive
+from app.bloom import TxIdFilter
+from app.changes import format_cursor, parse_cursor
+from app.comments import extract_comments, save_comments
+from app.compression import dictionaries, pack, unpack, unpack_text
 from app.exceptions import InvalidUsageError
-from app.models import FeedbackResponse, SurveyResponse
+from app.ingest import read_submission
+from app.log import log_stats
+from app.migrations import apply_migrations, unapplied_versions
+from app.models import FeedbackResponse, SurveyResponse, latest_responses, response_comments, responses_seq
+from app.replicas import ReplicaSet
+from app.shards import SHARDED_TABLES, ShardSet
+from app.slowlog import not_recorded, slow_log
+from app.spool import Spool
+from app.statements import execute, statement_cache
+from app.validation import is_feedback, validate_submission
 from app import app, db, logger
 import settings
 
@@ -24,17 +45,49 @@ schema = Schema({
     'survey_id': str,
 })
 
+changes_schema = Schema({
+    # The write_txid and seq read to in each shard, joined by '-', then by '.'
+    'since': Match(r'^\d+(-\d+)?(\.\d+(-\d+)?)*$'),
+    'limit': All(Coerce(int), Range(min=1, max=settings.CHANGE_FEED_MAX_LIMIT)),
+    'wait': All(Coerce(int), Range(min=0, max=settings.CHANGE_FEED_MAX_WAIT)),
+})
+
+# Before anything uses the database, so that its connection pool is timed
+slow_log.init_app(app)
+
+shards = ShardSet(settings.DB_SHARD_URIS)
+shards.init_app(app)
+
+replicas = ReplicaSet(settings.DB_REPLICA_URIS, settings.DB_REPLICA_MAX_LAG, settings.DB_REPLICA_CHECK_INTERVAL,
+                      settings.DB_REPLICA_TIMEOUT)
+replicas.init_app(app)
+
+archive = Archive(settings.ARCHIVE_DIR) if settings.ARCHIVE_DIR else None
+
+tx_id_filter = TxIdFilter(settings.TX_ID_FILTER_CAPACITY, settings.TX_ID_FILTER_ERROR_RATE)
+
+exists_schema = Schema({'tx_ids': All([str], Length(min=1, max=settings.EXISTS_MAX_TX_IDS))}, required=True)
+
+lookup_schema = Schema({'tx_ids': All([str], Length(min=1, max=settings.LOOKUP_MAX_TX_IDS))}, required=True)
+
+spool = Spool(settings.SPOOL_DIR, settings.SPOOL_REPLAY_BATCH, settings.SPOOL_REPLAY_INTERVAL) if settings.SPOOL_DIR else None
+
 
 def create_tables():
     logger.info("Creating tables")
     db.create_all()
+    apply_migrations(db.engine)
+    for shard in shards.shards[1:]:
+        db.metadata.create_all(shard.engine, tables=SHARDED_TABLES)
+        apply_migrations(shard.engine, primary=False)
 
 
 if os.getenv("CREATE_TABLES", False):
     create_tables()
 
 
-def get_responses(tx_id=None, invalid=None):
+def page_args():
+    """Validates the request args and returns the page and per_page to use"""
     try:
         schema(request.args.to_dict())
     except MultipleInvalid:
@@ -42,23 +95,170 @@ def get_responses(tx_id=None, invalid=None):
 
     page = request.args.get('page', type=int, default=1)
     per_page = request.args.get('per_page', type=int, default=100)
+    return page, per_page
+
+
+# Statements run by the busiest routes.  Built once here and run with app.statements.execute, so each is compiled
+# once per database and after that only has its parameters bound
+response_statement = select([SurveyResponse.data, SurveyResponse.body, SurveyResponse.dictionary_id]) \
+    .where(SurveyResponse.tx_id == bindparam('tx_id'))
 
-    kwargs = {k: v for k, v in {'tx_id': tx_id, 'invalid': invalid}.items() if v is not None}
+tx_ids_param = cast(bindparam('tx_ids', type_=ARRAY(String)), ARRAY(UUID))
+
+stored_tx_ids_statement = select([SurveyResponse.tx_id]).where(SurveyResponse.tx_id == any_(tx_ids_param))
+
+responses_statement = select([SurveyResponse.tx_id, SurveyResponse.data, SurveyResponse.body, SurveyResponse.dictionary_id]) \
+    .where(SurveyResponse.tx_id == any_(tx_ids_param))
+
+
+def get_response(tx_id):
+    """Returns the data of the response with tx_id, or None if it isn't stored.  It is read from a healthy replica if
+    there is one and tx_id belongs on the primary.  If it isn't found there it is looked for on its shard too,
+    in case it hasn't been replicated yet, then on the others while shards are rebalancing
+    """
+    shard = shards.for_tx_id(tx_id)
+    replica = replicas.choose() if shard.number == 0 else None
+    if replica:
+        try:
+            row = execute(replica.session(), response_statement, {'tx_id': tx_id}).first()
+            if row:
+                logger.info("Retrieved response from replica", tx_id=tx_id)
+                return unpack(*row)
+        except SQLAlchemyError as e:
+            replicas.failed(replica, e)
 
     try:
-        r = SurveyResponse.query.filter_by(**kwargs).paginate(page, per_page)
-        logger.info("Retrieved results from db", tx_id=tx_id, invalid=invalid)
-        return r
+        row = execute(shard.session, response_statement, {'tx_id': tx_id}).first()
+        for other in shards.elsewhere([tx_id]) if row is None else ():
+            row = execute(other.session, response_statement, {'tx_id': tx_id}).first()
+            if row:
+                logger.info("Retrieved response from old shard", tx_id=tx_id, shard=other.number)
+                break
     except SQLAlchemyError as e:
-        logger.error("Could not retrieve results from db",
-                     tx_id=tx_id,
-                     invalid=invalid,
-                     error=e)
+        logger.error("Could not retrieve results from db", tx_id=tx_id, error=e)
+        return None
+    logger.info("Retrieved response from db", tx_id=tx_id)
+    return unpack(*row) if row else None
+
+
+def get_responses_json(invalid):
+    """Returns a page of responses as the text of a JSON array, built by Postgres rather than by loading the rows
+    into SurveyResponse objects and encoding them again.  The array has the same content as jsonify-ing
+    SurveyResponse.to_dict() for each row.  Reads go to a healthy replica if there is one.
+    Only compressed responses are decoded here, and only to be spliced into what Postgres made of the rest of them
+    """
+    page, per_page = page_args()
+    if shards.sharded:
+        return gather_responses_json(invalid, page, per_page)
+    query = responses_json_query(invalid, page, per_page)
+
+    body = None
+    replica = replicas.choose()
+    if replica:
+        try:
+            body = page_json(replica.session().execute(query))
+            logger.info("Retrieved results from replica", invalid=invalid)
+        except SQLAlchemyError as e:
+            replicas.failed(replica, e)
+
+    if body is None:
+        try:
+            body = page_json(db.session.execute(query))
+            logger.info("Retrieved results from db", invalid=invalid)
+        except SQLAlchemyError as e:
+            logger.error("Could not retrieve results from db", invalid=invalid, error=e)
+            return None
+
+    # Match paginate(), which 404s for an empty page other than the first
+    if body == '[]' and page != 1:
+        abort(404)
+    return body
+
+
+def responses_json_query(invalid, page, per_page):
+    rows = select(page_columns) \
+        .where(SurveyResponse.invalid == invalid) \
+        .limit(per_page) \
+        .offset((page - 1) * per_page) \
+        .alias('page')
+    return select(response_json(rows)).select_from(rows)
+
+
+page_columns = [SurveyResponse.tx_id, SurveyResponse.ts, SurveyResponse.invalid, SurveyResponse.data,
+                SurveyResponse.body, SurveyResponse.dictionary_id]
+
+# How Postgres starts the JSON of a compressed response, which has its data spliced in by item_json()
+COMPRESSED_ITEM_START = '{"data" : null'
+
+
+def response_json(rows):
+    """Columns giving the JSON object jsonify would make of SurveyResponse.to_dict() for each of rows, once passed
+    to item_json().  Compressed responses are encoded with null data, plus their body and dictionary
+    """
+    # Same format as the http_date that flask's encoder uses for datetimes
+    ts = func.to_char(func.timezone('UTC', rows.c.ts), 'Dy, DD Mon YYYY HH24:MI:SS "GMT"')
+    item = func.json_build_object('data', case([(rows.c.body.isnot(None), null())], else_=rows.c.data),
+                                  'invalid', rows.c.invalid,
+                                  'ts', ts,
+                                  'tx_id', rows.c.tx_id)
+    return [cast(item, Text), rows.c.body, rows.c.dictionary_id]
+
+
+def item_json(item, body, dictionary_id):
+    if body is None:
+        return item
+    return '{"data":' + unpack_text(body, dictionary_id) + item[len(COMPRESSED_ITEM_START):]
+
+
+def page_json(rows):
+    return '[' + ','.join(item_json(*row) for row in rows) + ']'
+
+
+def gather_responses_json(invalid, page, per_page):
+    """Builds a page of responses from every shard, in ts then tx_id order.  Each shard returns the first
+    page * per_page of its responses in that order, already encoded by Postgres, and the page is cut from the merge
+    """
+    rows = select(page_columns) \
+        .where(SurveyResponse.invalid == invalid) \
+        .order_by(SurveyResponse.ts, SurveyResponse.tx_id) \
+        .limit(page * per_page) \
+        .alias('page')
+    # Sorting on the epoch keeps a null ts comparable
+    query = select([func.coalesce(func.extract('epoch', rows.c.ts), 0), rows.c.tx_id] + response_json(rows))
+
+    def fetch(shard):
+        with shard.engine.begin() as conn:
+            return [(row[0], row[1], item_json(*row[2:])) for row in conn.execute(query)]
+
+    try:
+        results = shards.scatter(fetch)
+    except SQLAlchemyError as e:
+        logger.error("Could not retrieve results from shards", invalid=invalid, error=e)
+        return None
+    logger.info("Retrieved results from shards", invalid=invalid, shards=len(results))
+
+    items = [row[2] for row in itertools.islice(heapq.merge(*results), (page - 1) * per_page, page * per_page)]
+    if not items and page != 1:
+        abort(404)
+    return '[' + ','.join(items) + ']'
 
 
 def get_feedback(feedback_id):
+    """Returns a list holding the feedback with the given id, or an empty list.  Reads go to a healthy replica
+    if there is one, falling back to the primary for an id that hasn't been replicated yet
+    """
+    replica = replicas.choose()
+    if replica:
+        try:
+            r = FeedbackResponse.query.with_session(replica.session()).filter_by(id=feedback_id).all()
+            if r:
+                logger.info("Retrieved feedback from replica")
+                return r
+        except SQLAlchemyError as e:
+            replicas.failed(replica, e)
+
     try:
-        r = FeedbackResponse.query.filter_by(id=feedback_id)
+        r = FeedbackResponse.query.filter_by(id=feedback_id).all()
         logger.info("Retrieved feedback from db")
         return r
     except SQLAlchemyError as e:
@@ -67,28 +267,283 @@ def get_feedback(feedback_id):
                      error=e)
 
 
-# pylint: disable=maybe-no-member
+def get_changes(since, limit):
+    """Returns up to limit changes after since, the position read to in each shard, as dicts of the shard,
+    write_txid, seq and tx_id.  Each shard's changes come in write_txid then seq order, and the shards take turns,
+    so a busy one doesn't hold back the rest.  Rows are held back until every transaction older than the oldest
+    still running has finished.  Any row committed later has a write_txid at or above that, so it sorts after
+    everything already handed out and a cursor never skips one.  A seq alone couldn't promise that, as a
+    transaction can take its seq before another that gets an earlier transaction id
+    """
+    horizon = func.txid_snapshot_xmin(func.txid_current_snapshot())
+
+    def fetch(shard):
+        write_txid, seq = since[shard.number]
+        if write_txid is None:
+            after = SurveyResponse.seq > seq
+        else:
+            after = tuple_(SurveyResponse.write_txid, SurveyResponse.seq) > tuple_(write_txid, seq)
+        query = select([SurveyResponse.write_txid, SurveyResponse.seq, SurveyResponse.tx_id]) \
+            .where(and_(after, SurveyResponse.write_txid < horizon)) \
+            .order_by(SurveyResponse.write_txid, SurveyResponse.seq) \
+            .limit(limit)
+        # Only holds the connection for the query, so it is back in the pool before a long-poll starts waiting
+        with shard.engine.begin() as conn:
+            return conn.execute(query).fetchall()
+
+    turns = sorted((position, number, row) for number, rows in enumerate(shards.scatter(fetch))
+                   for position, row in enumerate(rows))
+    return [{'shard': number, 'write_txid': row.write_txid, 'seq': row.seq, 'tx_id': row.tx_id}
+            for _, number, row in turns[:limit]]
+
+
+def advance(since, changes):
+    """Returns the position read to in each shard once changes have been read after since"""
+    positions = list(since)
+    for change in changes:
+        positions[change['shard']] = (change['write_txid'], change['seq'])
+    return positions
+
+
+def wait_for_changes(since, limit, wait):
+    """Reads changes after since, blocking for up to wait seconds for a new write to any shard if there are none yet"""
+    deadline = time.monotonic() + wait
+    while True:
+        generations = shards.listeners.current() if wait else None
+        changes = get_changes(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        shards.listeners.wait(generations, remaining)
+
+
+def save_statement():
+    """Statement that saves a response, replacing the stored one with the same tx_id, along with its
+    response_comments row, and notifies change feed listeners, in one round trip.  Postgres only delivers the
+    notification if the transaction commits.  As with the ORM merge it replaces, saving a response identical to the
+    stored one writes nothing, so its ts and seq are left alone and no notification is sent
+    """
+    responses = SurveyResponse.__table__
+    statement = insert(responses).values(tx_id=bindparam('tx_id'), invalid=bindparam('invalid'), data=bindparam('data'),
+                                         body=bindparam('body'), dictionary_id=bindparam('dictionary_id'))
+    stored = tuple_(responses.c.invalid, responses.c.data, responses.c.body, responses.c.dictionary_id)
+    excluded = tuple_(statement.excluded.invalid, statement.excluded.data, statement.excluded.body,
+                      statement.excluded.dictionary_id)
+    saved = statement \
+        .on_conflict_do_update(index_elements=[responses.c.tx_id],
+                               set_={'invalid': statement.excluded.invalid,
+                                     'data': statement.excluded.data,
+                                     'body': statement.excluded.body,
+                                     'dictionary_id': statement.excluded.dictionary_id,
+                                     'ts': func.now(),
+                                     'seq': responses_seq.next_value(),
+                                     'write_txid': func.txid_current()},
+                               where=stored.is_distinct_from(excluded)) \
+        .returning(responses.c.tx_id) \
+        .cte('saved')
+
+    # Only written with the response, and left out for one without a survey_id and period
+    survey_id = cast(bindparam('survey_id'), Text)
+    comments = select([survey_id, cast(bindparam('period'), Text), saved.c.tx_id, cast(bindparam('ru_ref'), Text),
+                       cast(bindparam('comment'), Text), cast(bindparam('boxes_selected'), ARRAY(Text)),
+                       cast(bindparam('additional', type_=JSONB), JSONB), func.now()]) \
+        .where(survey_id.isnot(None))
+    commented = save_comments(insert(response_comments).from_select(
+        ['survey_id', 'period', 'tx_id', 'ru_ref', 'comment', 'boxes_selected', 'additional', 'ts'], comments)) \
+        .returning(response_comments.c.tx_id) \
+        .cte('commented')
+
+    # Joined to commented so that it is part of the statement
+    return select([func.pg_notify(settings.CHANGE_FEED_CHANNEL, cast(saved.c.tx_id, Text))]) \
+        .select_from(saved.outerjoin(commented, commented.c.tx_id == saved.c.tx_id))
+
+
+save_response_statement = save_statement()
+
+# The comment parameters of save_response_statement for a response without a survey_id and period
+NO_COMMENTS = dict.fromkeys(('survey_id', 'period', 'ru_ref', 'comment', 'boxes_selected', 'additional'))
+
+
 def merge(response):
+    """Saves response, a dict of the responses columns to write and the response_comments columns to write with them"""
+    session = shards.for_tx_id(response['tx_id']).session
     try:
-        db.session.merge(response)
-        db.session.commit()
+        execute(session, save_response_statement, response)
+        session.commit()
     except IntegrityError as e:
         logger.error("Integrity error in database. Rolling back commit",
                      error=e)
-        db.session.rollback()
+        session.rollback()
         raise e
     except SQLAlchemyError as e:
         logger.error("Unable to save response", error=e)
-        db.session.rollback()
+        session.rollback()
         raise e
     else:
-        logger.info("Response saved", tx_id=response.tx_id)
+        logger.info("Response saved", tx_id=response['tx_id'])
+        tx_id_filter.add(response['tx_id'])
+
+
+def scan_tx_ids():
+    """Yields every stored tx_id, using a server side cursor so the whole table is never held in memory"""
+    for shard in shards.shards:
+        with shard.engine.connect() as conn:
+            for row in conn.execution_options(stream_results=True).execute(select([SurveyResponse.tx_id])):
+                yield row[0]
+
+
+@app.before_first_request
+def load_tx_id_filter():
+    # The scan starts once every shard is being listened to, so that nothing written by other processes during it
+    # is missed, and again on every reconnection
+    shards.listeners.subscribe(tx_id_filter.add_all, on_listen=lambda: tx_id_filter.listen(scan_tx_ids),
+                               on_lost=tx_id_filter.lost)
+
+
+@app.before_first_request
+def start_spool_replayer():
+    if spool:
+        spool.start(replay_spooled)
+
+
+def spool_response(bound_logger, tx_id, invalid, survey_response):
+    """Journals a response that couldn't be saved, to be saved by replay_spooled once the database is back"""
+    spool.append({'tx_id': tx_id,
+                  'invalid': bool(invalid),
+                  'data': survey_response,
+                  'spooled_at': datetime.datetime.now(datetime.timezone.utc).isoformat()})
+    bound_logger.warning("Database unavailable, response spooled")
+
+
+def replay_spooled(records):
+    """Saves a batch of spooled responses and their comments in one transaction.  A response that has been saved
+    since it was spooled is left alone, so replaying a batch again changes nothing
+    """
+    statement = insert(SurveyResponse.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SurveyResponse.tx_id],
+        set_={'invalid': statement.excluded.invalid,
+              'data': statement.excluded.data,
+              'body': statement.excluded.body,
+              'dictionary_id': statement.excluded.dictionary_id,
+              'ts': func.now(),
+              'seq': responses_seq.next_value(),
+              'write_txid': func.txid_current()},
+        where=SurveyResponse.ts < cast(bindparam('spooled_at'), db.TIMESTAMP(timezone=True)))
+    # A response's comments have its ts, so are left alone under the same condition
+    comments_statement = save_comments(where=response_comments.c.ts < cast(bindparam('spooled_at'), db.TIMESTAMP(timezone=True)))
+
+    for shard, tx_ids in shards.group(record['tx_id'] for record in records).items():
+        shard_records = [record for record in records if record['tx_id'] in tx_ids]
+        comments = []
+        for record in shard_records:
+            row = extract_comments(record['data'])
+            if row:
+                comments.append(dict(row, tx_id=record['tx_id'], spooled_at=record['spooled_at']))
+        with shard.engine.begin() as conn:
+            conn.execute(statement, [dict(record, **pack(record['data'])) for record in shard_records])
+            if comments:
+                conn.execute(comments_statement, comments)
+            conn.execute(select([func.pg_notify(settings.CHANGE_FEED_CHANNEL, func.unnest(bindparam('tx_ids')))]),
+                         tx_ids=tx_ids)
+        tx_id_filter.add_all(tx_ids)
+
+
+def responses_exist(tx_ids):
+    """Returns the set of tx_ids that are stored.  Only the ones the filter can't rule out are looked up,
+    with one query on each shard they belong on, never a replica, so that a write is seen as soon as it is acknowledged.
+    While shards are rebalancing those not found are looked up on the other shards too
+    """
+    tx_id_filter.load(scan_tx_ids)
 
+    maybe = [tx_id for tx_id in tx_ids if tx_id_filter.might_contain(tx_id)]
+    found = set()
+    for shard, shard_tx_ids in shards.group(maybe).items():
+        found.update(tx_id for tx_id, in execute(shard.session, stored_tx_ids_statement, {'tx_ids': shard_tx_ids}))
+    for shard, shard_tx_ids in shards.elsewhere([tx_id for tx_id in maybe if tx_id not in found]).items():
+        found.update(tx_id for tx_id, in execute(shard.session, stored_tx_ids_statement, {'tx_ids': shard_tx_ids}))
 
-def object_as_dict(obj):
-    """Converts a sqlalchemy object into a dictionary where the column names are the keys"""
-    return {column.key: getattr(obj, column.key)
-            for column in inspect(obj).mapper.column_attrs}
+    if archive:
+        found.update(tx_id for tx_id in tx_ids if tx_id not in found and archive.get(tx_id))
+    return found
+
+
+def lookup_responses(tx_ids):
+    """Returns {tx_id: data} for those of tx_ids that are stored.  They are fetched with one query, from a healthy
+    replica if there is one.  Any it doesn't have are fetched from the primary in case they haven't been replicated
+    yet, then from the other shards while shards are rebalancing, then looked for in the archive.  Tx_ids the filter
+    rules out are never queried
+    """
+    tx_id_filter.load(scan_tx_ids)
+    wanted = [tx_id for tx_id in tx_ids if tx_id_filter.might_contain(tx_id)]
+
+    found = {}
+    groups = shards.group(wanted)
+    primary_tx_ids = groups.get(shards.shards[0])
+    replica = replicas.choose() if primary_tx_ids else None
+    if replica:
+        try:
+            found.update(fetch_responses(replica.session(), primary_tx_ids))
+        except SQLAlchemyError as e:
+            replicas.failed(replica, e)
+
+    for shard, shard_tx_ids in groups.items():
+        missing = [tx_id for tx_id in shard_tx_ids if tx_id not in found]
+        if missing:
+            found.update(fetch_responses(shard.session, missing))
+    for shard, shard_tx_ids in shards.elsewhere([tx_id for tx_id in wanted if tx_id not in found]).items():
+        missing = [tx_id for tx_id in shard_tx_ids if tx_id not in found]
+        if missing:
+            found.update(fetch_responses(shard.session, missing))
+
+    if archive:
+        for tx_id in tx_ids:
+            record = archive.get(tx_id) if tx_id not in found else None
+            if record:
+                found[tx_id] = record['data']
+    return found
+
+
+def fetch_responses(session, tx_ids):
+    rows = execute(session, responses_statement, {'tx_ids': tx_ids})
+    return {tx_id: unpack(data, body, dictionary_id) for tx_id, data, body, dictionary_id in rows}
+
+
+latest_responses_statement = select([latest_responses.c.ru_ref, latest_responses.c.tx_id, latest_responses.c.submitted_at,
+                                     func.coalesce(func.extract('epoch', latest_responses.c.ts), 0).label('saved'),
+                                     SurveyResponse.data, SurveyResponse.body, SurveyResponse.dictionary_id]) \
+    .select_from(latest_responses.join(SurveyResponse.__table__, latest_responses.c.tx_id == SurveyResponse.tx_id)) \
+    .where(and_(latest_responses.c.survey_id == bindparam('survey_id'),
+                latest_responses.c.period == bindparam('period'),
+                latest_responses.c.ru_ref == any_(bindparam('ru_refs', type_=ARRAY(Text)))))
+
+
+def get_latest_responses(survey_id, period, ru_refs):
+    """Returns {ru_ref: row} for the newest response to the survey period from each of ru_refs that has one, each row
+    with the response's tx_id, submitted_at and data.  Each shard is asked with one primary key lookup joined to the
+    responses, and the newest is taken where more than one has a response from the same unit.  Replicas aren't used,
+    as a lagging one would give an older response without anything to tell it is stale
+    """
+    params = {'survey_id': survey_id, 'period': period, 'ru_refs': ru_refs}
+
+    def fetch(shard):
+        with shard.engine.begin() as conn:
+            return execute(conn, latest_responses_statement, params).fetchall()
+
+    latest = {}
+    for rows in shards.scatter(fetch):
+        for row in rows:
+            newest = latest.get(row.ru_ref)
+            if newest is None or (row.submitted_at or '', row.saved) > (newest.submitted_at or '', newest.saved):
+                latest[row.ru_ref] = row
+    return latest
+
+
+def normalise_tx_id(tx_id):
+    try:
+        return str(uuid.UUID(tx_id))
+    except (ValueError, AttributeError, TypeError):
+        raise InvalidUsageError("tx_id supplied is not a valid UUID", 400)
 
 
 def save_response(bound_logger, survey_response):
@@ -105,14 +560,31 @@ def save_response(bound_logger, survey_response):
         raise InvalidUsageError("Missing transaction id. Unable to save response",
                                 400)
 
-    response = SurveyResponse(tx_id=tx_id,
-                              invalid=invalid,
-                              data=survey_response)
-
-    merge(response)
+    comments = extract_comments(survey_response) or NO_COMMENTS
+    merge(dict(pack(survey_response), tx_id=tx_id, invalid=bool(invalid), **comments))
     return invalid
 
 
+def insert_feedback():
+    """Statement that saves a feedback response and returns its id and whether it was inserted, in one round trip.
+    Feedback with a tx_id that is already stored isn't saved again, and the stored one's id is returned instead
+    """
+    feedback = FeedbackResponse.__table__
+    inserted = insert(feedback) \
+        .values(tx_id=bindparam('tx_id'), invalid=bindparam('invalid'), data=bindparam('data'),
+                survey=bindparam('survey'), period=bindparam('period')) \
+        .on_conflict_do_nothing(index_elements=[feedback.c.tx_id]) \
+        .returning(feedback.c.id) \
+        .cte('inserted')
+    return select([inserted.c.id, true()]).union_all(existing_feedback_statement).limit(1)
+
+
+existing_feedback_statement = select([FeedbackResponse.id, false()]) \
+    .where(FeedbackResponse.tx_id == cast(bindparam('tx_id'), UUID))
+
+insert_feedback_statement = insert_feedback()
+
+
 def save_feedback_response(bound_logger, survey_feedback_response):
     bound_logger.info("Saving feedback response")
     survey = survey_feedback_response.get("survey_id")
@@ -122,15 +594,15 @@ def save_feedback_response(bound_logger, survey_feedback_response):
     if invalid:
         survey_feedback_response.pop("invalid")
 
-    feedback_response = FeedbackResponse(invalid=invalid,
-                                         data=survey_feedback_response,
-                                         survey=survey,
-                                         period=period)
-
+    tx_id = survey_feedback_response.get("tx_id")
     try:
-        db.session.add(feedback_response)
-        db.session.flush()
-        new_id = feedback_response.id
+        row = execute(db.session, insert_feedback_statement,
+                      {'tx_id': tx_id, 'invalid': invalid, 'data': survey_feedback_response,
+                       'survey': survey, 'period': period}).first()
+        if row is None:
+            # Saved by a transaction that committed while the insert was running, so its row is only visible now
+            row = execute(db.session, existing_feedback_statement, {'tx_id': tx_id}).first()
+        new_id, inserted = row
         db.session.commit()
     except IntegrityError as e:
         logger.error("Integrity error in database. Rolling back commit", error=e)
@@ -140,8 +612,11 @@ def save_feedback_response(bound_logger, survey_feedback_response):
         logger.error("Unable to save response", error=e)
         db.session.rollback()
         raise e
-    else:
+
+    if inserted:
         logger.info("Feedback response saved")
+    else:
+        bound_logger.info("Feedback response already saved", feedback_id=new_id)
 
     return invalid, new_id
 
@@ -175,21 +650,17 @@ def invalid_usage_error(error):
 
 
 @app.route('/responses', methods=['POST'])
+@admit('ingest')
 def do_save_response():
-    try:
-        survey_response = request.get_json(force=True)
-    except BadRequest:
-        raise InvalidUsageError("Invalid POST request to /response",
-                                status_code=400,
-                                payload=request.args)
+    survey_response = read_submission(request)
+    validate_submission(survey_response)
 
     bound_logger = logger.bind(tx_id=survey_response.get('tx_id'))
-
-    response_type = str(survey_response.get('type'))
+    g.tx_id = survey_response.get('tx_id')
 
     result = {'tx_id': survey_response.get('tx_id')}
 
-    if response_type.find("feedback") != -1:
+    if is_feedback(survey_response):
         bound_logger = bound_logger.bind(response_type="feedback",
                                          survey_id=survey_response.get("survey_id"))
         result['feedback'] = True
@@ -202,14 +673,13 @@ def do_save_response():
             return server_error("Database error")
     else:
         result['feedback'] = False
-        try:
-            metadata = survey_response['metadata']
-        except KeyError:
-            raise InvalidUsageError("Missing metadata. Unable to save response", 400)
+        metadata = survey_response['metadata']
 
         bound_logger = bound_logger.bind(user_id=metadata.get('user_id'),
                                          ru_ref=metadata.get('ru_ref'))
 
+        # save_response pops the invalid key, but it's needed if the response has to be spooled
+        invalid = survey_response.get("invalid")
         try:
             invalid = save_response(bound_logger, survey_response)
 
@@ -217,6 +687,16 @@ def do_save_response():
             return server_error("Integrity error")
         except DataError:
             raise InvalidUsageError("Invalid characters in payload", 400, payload={'contains_invalid_character': True})
+        except (OperationalError, PoolTimeoutError):
+            if not spool:
+                return server_error("Database error")
+            try:
+                spool_response(bound_logger, result['tx_id'], invalid, survey_response)
+            except OSError as e:
+                logger.error("Could not spool response", error=e)
+                return server_error("Database error")
+            result['spooled'] = True
+            return jsonify(result), 202
         except SQLAlchemyError:
             return server_error("Database error")
 
@@ -227,24 +707,96 @@ def do_save_response():
 
 
 @app.route('/invalid-responses', methods=['GET'])
+@admit('list')
 def do_get_invalid_responses():
     """Returns every invalid response in the database"""
-    page = get_responses(invalid=True)
-    return jsonify([item.to_dict() for item in page.items])
+    return responses_json_response(get_responses_json(invalid=True))
 
 
 @app.route('/responses', methods=['GET'])
+@admit('list')
 def do_get_responses():
-    page = get_responses(invalid=False)
+    return responses_json_response(get_responses_json(invalid=False))
 
-    try:
-        return jsonify([item.to_dict() for item in page.items])
-    except AttributeError:
-        logger.exception("No items in page")
+
+def responses_json_response(body):
+    if body is None:
+        logger.error("No items in page")
         return jsonify({}), 404
 
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/responses/changes', methods=['GET'])
+@not_recorded
+def do_get_changes():
+    """Returns the tx_ids of responses written after the since cursor.  If there are none, wait makes the
+    request block for up to that many seconds until one is written.  Clients that accept text/event-stream
+    get the changes as server-sent events instead
+    """
+    try:
+        changes_schema(request.args.to_dict())
+    except MultipleInvalid:
+        raise InvalidUsageError("Request args failed schema validation", payload=request.args)
+
+    try:
+        since = parse_cursor(request.args.get('since', request.headers.get('Last-Event-ID', 0)), len(shards.shards))
+    except ValueError:
+        raise InvalidUsageError("Not a change feed cursor", payload=request.args)
+    limit = request.args.get('limit', type=int, default=100)
+    wait = request.args.get('wait', type=int, default=0)
+    streaming = request.accept_mimetypes.best == 'text/event-stream'
+
+    # A request that waits holds its worker thread throughout, so it needs one spare and a slot of its own class
+    route_class = 'changes' if wait or streaming else 'read'
+    if route_class == 'changes' and settings.WORKER_THREADS < 2:
+        raise InvalidUsageError("Waiting for changes needs more than one worker thread, poll without wait instead", 503)
+    if not admission.try_acquire(route_class):
+        return shed(route_class)
+    g.route_class = route_class
+
+    if streaming:
+        events = stream_changes(since, limit, wait or settings.CHANGE_FEED_MAX_WAIT)
+        response = Response(stream_with_context(events), mimetype='text/event-stream')
+        # The stream carries on after the view returns, so the slot is given back once the response is closed
+        response.call_on_close(lambda: admission.release(route_class))
+        return response
+
+    try:
+        changes = wait_for_changes(since, limit, wait)
+    except SQLAlchemyError as e:
+        logger.error("Could not retrieve changes from db", since=since, error=e)
+        return server_error("Database error")
+    finally:
+        admission.release(route_class)
+
+    return jsonify({'changes': changes, 'cursor': format_cursor(advance(since, changes))})
+
+
+def stream_changes(since, limit, duration):
+    """Yields server-sent events for changes after since until duration seconds have passed.  Clients
+    reconnect with the Last-Event-ID header to carry on where they left off
+    """
+    deadline = time.monotonic() + duration
+    while True:
+        try:
+            changes = wait_for_changes(since, limit, max(deadline - time.monotonic(), 0))
+        except SQLAlchemyError as e:
+            logger.error("Could not retrieve changes from db", since=since, error=e)
+            return
+
+        for change in changes:
+            since = advance(since, [change])
+            yield 'id: {}\ndata: {}\n\n'.format(format_cursor(since), json.dumps(change))
+
+        if time.monotonic() >= deadline:
+            return
+        if not changes:
+            yield ': keepalive\n\n'
+
 
 @app.route('/feedback/<feedback_id>', methods=['GET'])
+@admit('read')
 def do_get_feedback(feedback_id):
     try:
         int(feedback_id)
@@ -265,31 +817,167 @@ def do_get_feedback(feedback_id):
         return jsonify({}), 404
 
 
+@app.route('/responses/exists', methods=['POST'])
+@admit('read')
+def do_responses_exist():
+    """Takes {"tx_ids": [...]} and returns {tx_id: true or false} saying which of them are stored"""
+    try:
+        body = exists_schema(request.get_json(force=True))
+    except (BadRequest, MultipleInvalid):
+        raise InvalidUsageError("Request body failed schema validation", 400)
+
+    tx_ids = {tx_id: normalise_tx_id(tx_id) for tx_id in body['tx_ids']}
+    try:
+        found = responses_exist(set(tx_ids.values()))
+    except SQLAlchemyError as e:
+        logger.error("Could not check responses exist", error=e)
+        return server_error("Database error")
+
+    return jsonify({tx_id: normalised in found for tx_id, normalised in tx_ids.items()})
+
+
+@app.route('/responses/lookup', methods=['POST'])
+@admit('read')
+def do_lookup_responses():
+    """Takes {"tx_ids": [...]} and returns an entry for each, saying whether it was found and if so with its data and
+    the digest that GET /responses/<tx_id> would send as Content-MD5.  Clients that accept application/x-ndjson get
+    one line per tx_id, in the order asked for, otherwise it is one object keyed by tx_id
+    """
+    try:
+        body = lookup_schema(request.get_json(force=True))
+    except (BadRequest, MultipleInvalid):
+        raise InvalidUsageError("Request body failed schema validation", 400)
+
+    tx_ids = {tx_id: normalise_tx_id(tx_id) for tx_id in body['tx_ids']}
+    try:
+        found = lookup_responses(set(tx_ids.values()))
+    except SQLAlchemyError as e:
+        logger.error("Could not look up responses", error=e)
+        return server_error("Database error")
+
+    logger.info("Looked up responses", count=len(tx_ids), found=len(found))
+    items = [(tx_id, lookup_item(found.get(normalised))) for tx_id, normalised in tx_ids.items()]
+
+    if request.accept_mimetypes.best == 'application/x-ndjson':
+        lines = (json.dumps(dict(item, tx_id=tx_id)) + '\n' for tx_id, item in items)
+        return Response(lines, mimetype='application/x-ndjson')
+    return jsonify(dict(items))
+
+
+def lookup_item(data):
+    if data is None:
+        return {'found': False}
+
+    # Encoded exactly as jsonify would, so that the digest matches GET /responses/<tx_id>
+    encoded = flask_json.dumps(data, separators=(',', ':')) + '\n'
+    return {'found': True, 'content_md5': hashlib.md5(encoded.encode('utf-8')).hexdigest(), 'data': data}
+
+
+@app.route('/responses/latest', methods=['GET'])
+@admit('read')
+def do_get_latest_responses():
+    """Takes survey_id, period and one or more ru_ref args and returns an entry for each ru_ref, saying whether that
+    reporting unit has a response to the survey period and if so with the newest one's tx_id, submitted_at, data
+    and content_md5
+    """
+    survey_id = request.args.get('survey_id')
+    period = request.args.get('period')
+    ru_refs = request.args.getlist('ru_ref')
+    if not survey_id or not period or not ru_refs or len(ru_refs) > settings.LATEST_MAX_RU_REFS:
+        raise InvalidUsageError("Request args failed schema validation", payload=request.args)
+
+    try:
+        latest = get_latest_responses(survey_id, period, ru_refs)
+    except SQLAlchemyError as e:
+        logger.error("Could not retrieve latest responses", survey_id=survey_id, period=period, error=e)
+        return server_error("Database error")
+
+    logger.info("Retrieved latest responses", survey_id=survey_id, period=period, count=len(ru_refs), found=len(latest))
+    items = {}
+    for ru_ref in ru_refs:
+        row = latest.get(ru_ref)
+        if row is None:
+            items[ru_ref] = lookup_item(None)
+        else:
+            items[ru_ref] = dict(lookup_item(unpack(row.data, row.body, row.dictionary_id)),
+                                 tx_id=row.tx_id, submitted_at=row.submitted_at)
+    return jsonify(items)
+
+
 @app.route('/responses/<tx_id>', methods=['GET'])
+@admit('read')
 def do_get_response(tx_id):
     try:
         uuid.UUID(tx_id, version=4)
     except ValueError:
         raise InvalidUsageError("tx_id supplied is not a valid UUID", 400)
 
-    result = get_responses(tx_id=tx_id)
-    logger.info('result: {}'.format(result))
-    if result:
+    # Flask answers HEAD with this view too.  That only needs to know whether the response exists
+    if request.method == 'HEAD':
+        normalised = normalise_tx_id(tx_id)
         try:
-            result_dict = object_as_dict(result.items[0])['data']
-            response = jsonify(result_dict)
-            response.headers['Content-MD5'] = hashlib.md5(response.data).hexdigest()
-            return response
-        except IndexError:
-            logger.exception('Empty items list in result.')
-            return jsonify({}), 404
-    else:
-        return jsonify({}), 404
+            exists = normalised in responses_exist({normalised})
+        except SQLAlchemyError as e:
+            logger.error("Could not check response exists", tx_id=tx_id, error=e)
+            return server_error("Database error")
+        return ('', 200) if exists else ('', 404)
+
+    data = get_response(tx_id)
+    if data is not None:
+        return response_with_md5(data)
+
+    if archive:
+        record = archive.get(tx_id)
+        if record:
+            logger.info('Retrieved response from archive', tx_id=tx_id)
+            return response_with_md5(record['data'])
+
+    logger.info('Response not found', tx_id=tx_id)
+    return jsonify({}), 404
+
+
+def response_with_md5(data):
+    response = jsonify(data)
+    response.headers['Content-MD5'] = hashlib.md5(response.data).hexdigest()
+    return response
+
+
+def archive_old_responses(shard, cut_off_date):
+    """Moves responses on shard older than cut_off_date into the archive, a segment at a time, and returns how many
+    were moved.  Each segment is written and synced to disk before its rows are deleted
+    """
+    query = select([SurveyResponse.tx_id, SurveyResponse.ts, SurveyResponse.invalid, SurveyResponse.data,
+                    SurveyResponse.body, SurveyResponse.dictionary_id]) \
+        .where(SurveyResponse.ts < cut_off_date) \
+        .order_by(SurveyResponse.tx_id) \
+        .limit(settings.ARCHIVE_SEGMENT_SIZE) \
+        .with_for_update()
+
+    archived_count = 0
+    while True:
+        with shard.engine.begin() as conn:
+            rows = conn.execute(query).fetchall()
+            if not rows:
+                return archived_count
+
+            archive.write_segment([{'tx_id': row.tx_id,
+                                    'ts': row.ts.isoformat() if row.ts else None,
+                                    'invalid': row.invalid,
+                                    'data': unpack(row.data, row.body, row.dictionary_id)} for row in rows])
+            conn.execute(delete(SurveyResponse.__table__).where(SurveyResponse.tx_id.in_([row.tx_id for row in rows])))
+        archived_count += len(rows)
+
+
+def delete_old_responses_from(shard, cut_off_date):
+    with shard.engine.begin() as conn:
+        return conn.execute(delete(SurveyResponse.__table__).where(SurveyResponse.ts < cut_off_date)).rowcount
 
 
 @app.route('/responses/old', methods=['DELETE'])
+@admit('admin')
 def delete_old_responses():
-    """Deletes responses that are older than the number of days set in config
+    """Deletes responses that are older than the number of days set in config, or moves them to the archive
+    if one is configured.
     Config use is a compromise for safety in case incorrect parameters are passed.
     """
     try:
@@ -303,31 +991,90 @@ def delete_old_responses():
         cut_off_date = cut_off_date.combine(cut_off_date.date(),
                                             datetime.time(hour=0, minute=0, second=0, microsecond=0, tzinfo=None))
 
-        deleted_count = db.session.query(SurveyResponse).filter(SurveyResponse.ts < cut_off_date) \
-            .delete(synchronize_session=False)
-        db.session.commit()
+        # Every shard is cleared at once
+        if archive:
+            deleted_count = sum(shards.scatter(lambda shard: archive_old_responses(shard, cut_off_date)))
+            logger.info('Old submissions archived', count=deleted_count, segments=archive.segment_count())
+        else:
+            deleted_count = sum(shards.scatter(lambda shard: delete_old_responses_from(shard, cut_off_date)))
 
         logger.info('Old submissions deleted', count=deleted_count, cut_off_date=cut_off_date.strftime('%Y-%d-%m'))
 
     except SQLAlchemyError:
+        db.session.rollback()
         return server_error("Database error")
+    except OSError as e:
+        logger.error('Could not write archive segment', error=e)
+        db.session.rollback()
+        return server_error("Archive error")
     except TypeError:  # Thrown if RESPONSE_RETENTION_DAYS is not set
         return server_error('Response retention days not configured')
 
     return jsonify({}), 204
 
 
-@app.route('/info', methods=['GET'])
+# Set once every database has been found with every migration applied, after which the healthcheck stops looking.
+# Until then the service isn't healthy: the routes rely on columns and tables that migrations add
+migrated = False
+
+
+def check_migrated():
+    """Returns the versions of migrations still to be applied to each shard that has any, as {shard: [version]}"""
+    global migrated
+    if migrated:
+        return {}
+
+    unapplied = {}
+    for shard in shards.shards:
+        with shard.engine.connect() as conn:
+            versions = unapplied_versions(conn)
+        if versions:
+            unapplied[shard.number] = versions
+    migrated = not unapplied
+    return unapplied
+
+
 @app.route('/healthcheck', methods=['GET'])
 def healthcheck():
     try:
         logger.info("Checking database connection")
         conn = db.engine.connect()
         test_sql(conn)
+        unapplied = check_migrated()
     except SQLAlchemyError:
         return server_error("Failed to connect to database")
-    else:
-        return jsonify({'status': 'OK'})
+    if unapplied:
+        logger.error("Migrations not applied", unapplied=unapplied)
+        return server_error("Database migrations not applied, run migrate.py upgrade")
+    return jsonify({'status': 'OK'})
+
+
+@app.route('/info', methods=['GET'])
+def info():
+    """Healthcheck plus counters describing the service's internal state"""
+    response = healthcheck()
+    if response.status_code != 200:
+        return response
+
+    return jsonify({'status': 'OK',
+                    'logging': log_stats(),
+                    'replicas': replicas.status(),
+                    'archive_segments': archive.segment_count() if archive else None,
+                    'tx_id_filter': tx_id_filter.status(),
+                    'admission': admission.status(),
+                    'spool': spool.status() if spool else None,
+                    'shards': shards.status(),
+                    'compression': dictionaries.status(),
+                    'statement_cache': statement_cache.status(),
+                    'slow_requests': slow_log.status()})
+
+
+@app.route('/admin/slow-requests', methods=['GET'])
+def slow_requests():
+    """The most recent requests that took longer than the slow request threshold, newest first, with the SQL
+    they ran and where their time went
+    """
+    return jsonify(dict(slow_log.status(), requests=slow_log.records()))
 
 
 if __name__ == '__main__':
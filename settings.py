@@ -4,6 +4,9 @@ import logging
 
 LOGGING_LEVEL = logging.getLevelName(os.getenv('LOGGING_LEVEL', 'DEBUG'))
 LOGGING_FORMAT = "%(asctime)s.%(msecs)06dZ|%(levelname)s: sdx-store: %(message)s"
+LOGGING_QUEUE_SIZE = int(os.getenv('LOGGING_QUEUE_SIZE', 10000))
+# Fraction of some high volume debug/info events to keep, e.g. 'Checking database connection=0.01'
+LOGGING_SAMPLE_RATES = os.getenv('LOGGING_SAMPLE_RATES', '')
 
 DB_HOST = os.getenv('SDX_STORE_POSTGRES_HOST', 'localhost')
 DB_PORT = os.getenv('SDX_STORE_POSTGRES_PORT', '5433')
@@ -14,3 +17,69 @@ DB_URI = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
 RESPONSE_RETENTION_DAYS = os.getenv('SDX_STORE_RESPONSE_RETENTION_DAYS')  # No default
 SQLALCHEMY_TRACK_MODIFICATIONS = os.getenv('SQLALCHEMY_TRACK_MODIFICATIONS', default=False)
+
+# Change feed (GET /responses/changes)
+CHANGE_FEED_CHANNEL = os.getenv('SDX_STORE_CHANGE_FEED_CHANNEL', 'sdx_store_responses')
+CHANGE_FEED_MAX_WAIT = int(os.getenv('SDX_STORE_CHANGE_FEED_MAX_WAIT', 25))  # seconds
+CHANGE_FEED_MAX_LIMIT = int(os.getenv('SDX_STORE_CHANGE_FEED_MAX_LIMIT', 1000))
+
+# Ingest pre-validation
+MAX_PAYLOAD_BYTES = int(os.getenv('SDX_STORE_MAX_PAYLOAD_BYTES', 20 * 1024 * 1024))
+MAX_PAYLOAD_DEPTH = int(os.getenv('SDX_STORE_MAX_PAYLOAD_DEPTH', 64))
+
+# Optional extra databases that responses are spread over by a hash of tx_id, as comma separated postgresql:// URIs.
+# The primary is always the first shard. Run scripts/rebalance_shards.py after changing them
+DB_SHARD_URIS = [uri.strip() for uri in os.getenv('SDX_STORE_POSTGRES_SHARD_URIS', '').split(',') if uri.strip()]
+# Set from changing the shard URIs until the rebalance has finished, so that reads of a response not yet moved to
+# the shard it now belongs on look for it on the others
+SHARDS_REBALANCING = os.getenv('SDX_STORE_SHARDS_REBALANCING', 'false').lower() == 'true'
+
+# Optional read replicas for GET endpoints, as comma separated postgresql:// URIs
+DB_REPLICA_URIS = [uri.strip() for uri in os.getenv('SDX_STORE_POSTGRES_REPLICA_URIS', '').split(',') if uri.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv('SDX_STORE_REPLICA_MAX_LAG', 30))  # seconds
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('SDX_STORE_REPLICA_CHECK_INTERVAL', 10))  # seconds
+# Seconds allowed to connect to a replica, and for a health check to run once connected
+DB_REPLICA_TIMEOUT = int(os.getenv('SDX_STORE_REPLICA_TIMEOUT', 2))
+
+# Optional archive for expired responses. When set, DELETE /responses/old moves them here rather than deleting them
+ARCHIVE_DIR = os.getenv('SDX_STORE_ARCHIVE_DIR')
+ARCHIVE_SEGMENT_SIZE = int(os.getenv('SDX_STORE_ARCHIVE_SEGMENT_SIZE', 10000))  # responses per segment file
+
+# Bloom filter over stored tx_ids answering HEAD /responses/<tx_id> and POST /responses/exists
+TX_ID_FILTER_CAPACITY = int(os.getenv('SDX_STORE_TX_ID_FILTER_CAPACITY', 5000000))
+TX_ID_FILTER_ERROR_RATE = float(os.getenv('SDX_STORE_TX_ID_FILTER_ERROR_RATE', 0.01))
+EXISTS_MAX_TX_IDS = int(os.getenv('SDX_STORE_EXISTS_MAX_TX_IDS', 1000))
+LOOKUP_MAX_TX_IDS = int(os.getenv('SDX_STORE_LOOKUP_MAX_TX_IDS', 500))  # most tx_ids fetched by POST /responses/lookup
+LATEST_MAX_RU_REFS = int(os.getenv('SDX_STORE_LATEST_MAX_RU_REFS', 500))  # most ru_refs fetched by GET /responses/latest
+
+# Admission control: most requests of each route class a worker handles at once, as 'class=limit,...'. The last
+# ADMISSION_RESERVED of ADMISSION_TOTAL are kept for ingest. Requests over a limit get a 503 with Retry-After
+# Change feed requests that wait for changes, by long-poll or server-sent events, are in the changes class and hold a
+# worker thread while they wait, so they are refused unless WORKER_THREADS leaves others to serve the rest
+ADMISSION_LIMITS = os.getenv('SDX_STORE_ADMISSION_LIMITS', 'ingest=32,read=16,list=4,admin=1,changes=2')
+ADMISSION_TOTAL = int(os.getenv('SDX_STORE_ADMISSION_TOTAL', 40))
+ADMISSION_RESERVED = int(os.getenv('SDX_STORE_ADMISSION_RESERVED', 8))
+ADMISSION_RETRY_AFTER = int(os.getenv('SDX_STORE_ADMISSION_RETRY_AFTER', 2))  # seconds
+# Per route class statement_timeout and lock_timeout in milliseconds, 0 for none
+STATEMENT_TIMEOUTS = os.getenv('SDX_STORE_STATEMENT_TIMEOUTS', 'ingest=10000,read=5000,list=20000,admin=0,changes=5000')
+LOCK_TIMEOUTS = os.getenv('SDX_STORE_LOCK_TIMEOUTS', 'ingest=5000,read=2000,list=2000,admin=10000,changes=2000')
+# Threads each worker serves requests on, as given to gunicorn by startup.sh
+WORKER_THREADS = int(os.getenv('GUNICORN_THREADS', 1))
+
+# Optional local spool. When set, survey responses that can't be saved because the database is unavailable are
+# journalled here, acknowledged with a 202 and saved by a background replayer once the database is back
+SPOOL_DIR = os.getenv('SDX_STORE_SPOOL_DIR')
+SPOOL_REPLAY_BATCH = int(os.getenv('SDX_STORE_SPOOL_REPLAY_BATCH', 500))  # responses saved per replay transaction
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SDX_STORE_SPOOL_REPLAY_INTERVAL', 5))  # seconds between replay attempts
+
+# Compressed storage. When on, responses to surveys with a dictionary trained by scripts/train_dictionaries.py are
+# stored zlib compressed with it, keeping only a few fields in the JSONB data column. Reads work either way
+COMPRESS_RESPONSES = os.getenv('SDX_STORE_COMPRESS_RESPONSES', 'false').lower() == 'true'
+COMPRESSION_LEVEL = int(os.getenv('SDX_STORE_COMPRESSION_LEVEL', 6))
+COMPRESSION_DICTIONARY_REFRESH = float(os.getenv('SDX_STORE_COMPRESSION_DICTIONARY_REFRESH', 60))  # seconds
+
+# Requests taking longer than this are logged with the SQL they ran and where their time went, and the last
+# SLOW_REQUEST_LOG_SIZE of them are kept for GET /admin/slow-requests
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SDX_STORE_SLOW_REQUEST_THRESHOLD', 1000))  # milliseconds
+SLOW_REQUEST_LOG_SIZE = int(os.getenv('SDX_STORE_SLOW_REQUEST_LOG_SIZE', 100))
+SLOW_REQUEST_MAX_STATEMENTS = int(os.getenv('SDX_STORE_SLOW_REQUEST_MAX_STATEMENTS', 200))  # listed per request
@@ -9,5 +9,5 @@ if [ "$SDX_DEV_MODE" = true ]
 then
     python3 server.py
 else
-    gunicorn -b 0.0.0.0:$PORT server:app
+    gunicorn -b 0.0.0.0:$PORT --threads ${GUNICORN_THREADS:-1} server:app
 fi
\ No newline at end of file